@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""attendance.py
+
+Conference registrations and session wishlists, stored as one small
+entity per membership under the attendee's Profile (Registration and
+WishlistEntry, keyed by the websafe conference/session key). Membership
+is a key lookup, adding or removing writes only that record, and
+"who is attending conference X" is a query on Registration.conference
+(attendeeQuery/iterAttendees).
+
+Profiles still holding the old conferenceKeysToAttend and
+sessionWishlistKeys lists are migrated on first use, or in bulk by the
+/tasks/migrate_attendance task.
+
+"""
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Registration
+from models import WishlistEntry
+
+ROSTER_BATCH = 500
+
+
+def registrationKey(p_key, wsck):
+    return ndb.Key(Registration, wsck, parent=p_key)
+
+
+def wishlistKey(p_key, wssk):
+    return ndb.Key(WishlistEntry, wssk, parent=p_key)
+
+
+def isRegistered(p_key, wsck):
+    return registrationKey(p_key, wsck).get() is not None
+
+
+def newRegistration(p_key, wsck):
+    return Registration(key=registrationKey(p_key, wsck),
+                        conference=ndb.Key(urlsafe=wsck))
+
+
+def newWishlistEntry(p_key, wssk):
+    sess_key = ndb.Key(urlsafe=wssk)
+    return WishlistEntry(key=wishlistKey(p_key, wssk), session=sess_key,
+                         conference=sess_key.parent())
+
+
+def conferenceKeysAsync(p_key):
+    """Future for the websafe keys of the conferences p_key attends."""
+    return Registration.query(ancestor=p_key).fetch_async(keys_only=True)
+
+
+def wishlistKeysAsync(p_key):
+    """Future for the websafe keys of the sessions on p_key's wishlist."""
+    return WishlistEntry.query(ancestor=p_key).fetch_async(keys_only=True)
+
+
+def attendanceKeys(p_key):
+    """Return (websafe conference keys, websafe session keys) for a
+    Profile, both ancestor queries running at once."""
+    confs, wishes = conferenceKeysAsync(p_key), wishlistKeysAsync(p_key)
+    return ([key.id() for key in confs.get_result()],
+            [key.id() for key in wishes.get_result()])
+
+
+def attendeeQuery(conf_key):
+    """Registrations for a Conference in key order; an equality filter
+    plus key order runs on the built-in index, and cursors page it."""
+    return Registration.query(
+        Registration.conference == conf_key).order(Registration.key)
+
+
+def attendeeRows(registrations):
+    """Return (Registration, Profile or None) pairs, the attendees'
+    Profiles (the registrations' parents) read with one get_multi."""
+    profiles = ndb.get_multi([reg.key.parent() for reg in registrations])
+    return zip(registrations, profiles)
+
+
+def iterAttendees(conf_key, batch_size=ROSTER_BATCH):
+    """Yield (Registration, Profile or None) for every attendee of a
+    Conference, holding one batch at a time; the next batch is fetched
+    while the current one is processed."""
+    query = attendeeQuery(conf_key)
+    future = query.fetch_page_async(batch_size)
+    while future:
+        registrations, cursor, more = future.get_result()
+        future = None
+        if more and cursor:
+            future = query.fetch_page_async(batch_size, start_cursor=cursor)
+        for row in attendeeRows(registrations):
+            yield row
+
+
+def needsMigration(prof):
+    return bool(prof.conferenceKeysToAttend or prof.sessionWishlistKeys)
+
+
+@ndb.transactional
+def migrateProfile(p_key):
+    """Move a Profile's legacy lists into child entities; returns the
+    (possibly unchanged) Profile."""
+    prof = p_key.get()
+    if not prof or not needsMigration(prof):
+        return prof
+    entities = [newRegistration(p_key, wsck)
+                for wsck in set(prof.conferenceKeysToAttend)]
+    entities += [newWishlistEntry(p_key, wssk)
+                 for wssk in set(prof.sessionWishlistKeys)]
+    prof.conferenceKeysToAttend = []
+    prof.sessionWishlistKeys = []
+    ndb.put_multi(entities + [prof])
+    return prof
+
+
+@ndb.transactional
+def setWishlisted(p_key, wssk, wished):
+    """Add (wished) or remove a session from a wishlist; returns False
+    if it was already in that state."""
+    entry_key = wishlistKey(p_key, wssk)
+    if (entry_key.get() is not None) == wished:
+        return False
+    if wished:
+        newWishlistEntry(p_key, wssk).put()
+    else:
+        entry_key.delete()
+    return True
+
+
+def migrateBatch(cursor=None, batch_size=100):
+    """Migrate one batch of Profiles; used by the migration task.
+    Returns the cursor to continue from, or None when done."""
+    if cursor:
+        cursor = Cursor(urlsafe=cursor)
+    profiles, next_cursor, more = Profile.query().fetch_page(
+        batch_size, start_cursor=cursor)
+    for prof in profiles:
+        if needsMigration(prof):
+            migrateProfile(prof.key)
+    if more and next_cursor:
+        return next_cursor.urlsafe()
+    return None
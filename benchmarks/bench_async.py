@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""bench_async.py -- critical path of the async endpoint paths.
+
+Runs getConference (cache miss), getConferencesToAttend and
+_storeSessions against the testbed stubs, next to the sequential code
+they replaced, and counts RPC rounds: a round starts when an RPC is
+issued with nothing else in flight, so RPCs that overlap share a round.
+With real services each round costs one round trip, so rounds x RTT is
+the critical path; the stubs answer at once, so the wall time printed
+is mostly CPU.
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_async.py
+
+"""
+
+import time
+
+import sdk
+sdk.setup()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import message_types
+from protorpc import protojson
+
+import attendance
+from conference import ConferenceApi
+from conference import FORM_CACHE_TTL
+from conference import MEMCACHE_SESSION_FORM_KEY
+from models import Conference, ConferenceForms
+from models import Profile
+from models import Session
+
+EMAIL = 'bench@example.com'
+CONFERENCES = 10
+SESSIONS = 20
+RTT_MS = 20.0
+REPEAT = 20
+
+
+class RoundCounter(object):
+    """apiproxy pre/post call hooks counting RPCs and RPC rounds."""
+
+    def __init__(self):
+        self.calls = self.rounds = self.in_flight = 0
+
+    def pre(self, service, call, request, response):
+        if not self.in_flight:
+            self.rounds += 1
+        self.in_flight += 1
+        self.calls += 1
+
+    def post(self, service, call, request, response):
+        self.in_flight -= 1
+
+    def install(self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rounds', self.pre)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'bench_rounds', self.post)
+
+    def reset(self):
+        self.calls = self.rounds = self.in_flight = 0
+
+
+def seqConference(api, wsck):
+    conf = ndb.Key(urlsafe=wsck).get()
+    prof = conf.key.parent().get()
+    return api._copyConferenceToForm(
+        conf, prof.displayName, conf.seatsAvailable)
+
+
+def seqConferencesToAttend(api):
+    prof = api._getProfileFromUser()
+    wscks, _ = attendance.attendanceKeys(prof.key)
+    conferences = ndb.get_multi([ndb.Key(urlsafe=wsck) for wsck in wscks])
+    names = api._getOrganizerNames(conferences)
+    return ConferenceForms(items=[
+        api._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+        for conf in conferences])
+
+
+def seqStoreSessions(api, conf_key, datas):
+    first, last = Session.allocate_ids(size=len(datas), parent=conf_key)
+    sessions = [Session(key=ndb.Key(Session, s_id, parent=conf_key), **data)
+                for s_id, data in zip(range(first, last + 1), datas)]
+    ndb.put_multi(sessions)
+    sess_keys = [sess.key.urlsafe() for sess in sessions]
+    api._queueFeaturedSpeaker(conf_key.urlsafe(), sess_keys)
+    forms = [api._copySessionToForm(sess) for sess in sessions]
+    memcache.set_multi(
+        dict((k, protojson.encode_message(sf))
+             for k, sf in zip(sess_keys, forms)),
+        time=FORM_CACHE_TTL, key_prefix=MEMCACHE_SESSION_FORM_KEY)
+    return forms
+
+
+def makeFixtures():
+    """One attendee, CONFERENCES conferences by different organizers."""
+    attendee = Profile(key=ndb.Key(Profile, EMAIL), displayName='bench',
+                       mainEmail=EMAIL, teeShirtSize='NOT_SPECIFIED')
+    entities = []
+    wscks = []
+    for i in range(CONFERENCES):
+        org_id = 'org%d@example.com' % i
+        org_key = ndb.Key(Profile, org_id)
+        entities.append(Profile(key=org_key, displayName='Org %d' % i,
+                                mainEmail=org_id))
+        conf = Conference(key=ndb.Key(Conference, 1, parent=org_key),
+                          name='Conference %d' % i, organizerUserId=org_id,
+                          city='London', topics=['Web'], maxAttendees=0,
+                          seatsAvailable=0)
+        entities.append(conf)
+        wscks.append(conf.key.urlsafe())
+        entities.append(attendance.newRegistration(attendee.key, wscks[-1]))
+    ndb.put_multi(entities + [attendee])
+    return wscks
+
+
+def sessionDatas(wsck):
+    return [dict(name='Session %d' % i, speakerKeys=[], duration=60,
+                 typeOfSession='Lecture', websafeConferenceKey=wsck)
+            for i in range(SESSIONS)]
+
+
+def measure(counter, fn):
+    """Return (rpcs, rounds, best ms) for fn, run REPEAT times."""
+    best = None
+    for _ in range(REPEAT):
+        counter.reset()
+        start = time.time()
+        fn()
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return counter.calls, counter.rounds, best
+
+
+def main():
+    bed = sdk.testbedEnv(EMAIL)
+    try:
+        # measure datastore round trips, not the in-context cache
+        ctx = ndb.get_context()
+        ctx.set_cache_policy(False)
+        ctx.set_memcache_policy(False)
+        wscks = makeFixtures()
+        conf_key = ndb.Key(urlsafe=wscks[0])
+        api = ConferenceApi()
+        counter = RoundCounter()
+        counter.install()
+
+        paths = [
+            ('getConference',
+             lambda: seqConference(api, wscks[0]),
+             lambda: api._loadConferenceForm(wscks[0])),
+            ('getConferencesToAttend',
+             lambda: seqConferencesToAttend(api),
+             lambda: api.getConferencesToAttend(
+                 message_types.VoidMessage())),
+            ('_storeSessions',
+             lambda: seqStoreSessions(api, conf_key, sessionDatas(wscks[0])),
+             lambda: api._storeSessions(conf_key, sessionDatas(wscks[0]))),
+        ]
+        print '%-34s %5s %7s %8s %8s' % (
+            'path', 'rpcs', 'rounds', 'est ms', 'stub ms')
+        for name, before, after in paths:
+            for label, fn in (('sequential', before), ('async', after)):
+                calls, rounds, best = measure(counter, fn)
+                print '%-34s %5d %7d %8.0f %8.1f' % (
+                    '%s (%s)' % (name, label), calls, rounds,
+                    rounds * RTT_MS, best)
+        print '(est ms = rounds x %.0f ms round trip)' % RTT_MS
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
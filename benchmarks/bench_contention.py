@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""bench_contention.py -- registration storm against one conference.
+
+Runs --workers threads that all register distinct attendees for the same
+conference through ConferenceApi._changeRegistration (the core behind
+registerForConference, taking the attendee's Profile key so no signed-in
+user is needed), optionally unregistering a share of them again. The
+testbed datastore stub applies real optimistic transactions: concurrent
+commits to the same seat shard fail and ndb retries them.
+
+Reports the commit rate, transaction attempts/retries and aborts (calls
+that still failed after ndb's retries), p50/p99/max latency, and checks
+the result: seats taken must equal the Registrations written and never
+exceed capacity (oversell), and no one may be left waiting while seats
+are free once the waitlist has been promoted (undersell). Exits 1 if a
+check fails.
+
+    APPENGINE_SDK=/path/to/google_appengine \\
+        python benchmarks/bench_contention.py --workers 50 --attendees 2000
+
+"""
+
+import argparse
+import collections
+import logging
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+
+import sdk
+from sdk import percentile
+sdk.setup()
+os.environ['INSTRUMENTATION'] = '0'
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import seats
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Registration
+from models import WaitlistEntry
+
+ORGANIZER = 'organizer@example.com'
+TXN_CALLS = ('BeginTransaction', 'Commit', 'Rollback')
+
+
+class TxnCounter(object):
+    """apiproxy post call hook counting datastore transaction calls;
+    failed ones are counted as '<call> failed'."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def post(self, service, call, request, response, rpc, error):
+        if service == 'datastore_v3' and call in TXN_CALLS:
+            with self.lock:
+                self.counts[call + ' failed' if error else call] += 1
+
+    def install(self):
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'bench_contention', self.post)
+
+
+def seedConference(capacity, shards):
+    seats.NUM_SEAT_SHARDS = shards
+    p_key = ndb.Key(Profile, ORGANIZER)
+    conf = Conference(key=ndb.Key(Conference, 1, parent=p_key),
+                      name='Contended', organizerUserId=ORGANIZER,
+                      city='London', maxAttendees=capacity,
+                      seatsAvailable=capacity)
+    ndb.put_multi([Profile(key=p_key, mainEmail=ORGANIZER), conf] +
+                  seats.newShards(conf))
+    return conf.key.urlsafe()
+
+
+def worker(jobs, results, wsck):
+    api = ConferenceApi()
+    while True:
+        try:
+            p_key, reg = jobs.get_nowait()
+        except Queue.Empty:
+            return
+        start = time.time()
+        try:
+            outcome = api._changeRegistration(p_key, wsck, reg).data
+        except Exception as e:
+            outcome = type(e).__name__
+        results.append((reg, outcome, (time.time() - start) * 1000))
+
+
+def runPromotions(bed):
+    """Run the /tasks/promote_waitlist tasks actually queued, and any
+    they queue in turn, as the task queue would; returns how many ran."""
+    stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    ran = 0
+    while True:
+        tasks = stub.get_filtered_tasks(url='/tasks/promote_waitlist')
+        if not tasks:
+            return ran
+        for task in tasks:
+            stub.DeleteTask('default', task.name)
+            ConferenceApi._promoteWaitlist(
+                task.extract_params()['websafeConferenceKey'])
+            ran += 1
+
+
+def audit(conf_key):
+    """Return (capacity, taken, registrations, waiting) from storage."""
+    conf = conf_key.get()
+    shards = [s for s in ndb.get_multi(seats.shardKeys(conf)) if s]
+    registrations = Registration.query(
+        Registration.conference == conf_key).count()
+    waiting = WaitlistEntry.query(
+        WaitlistEntry.conference == conf_key).count()
+    return (sum(s.capacity for s in shards), sum(s.taken for s in shards),
+            registrations, waiting)
+
+
+def check(label, conf_key, promoted):
+    capacity, taken, registrations, waiting = audit(conf_key)
+    free = capacity - taken
+    print '%-16s capacity %d, taken %d, registrations %d, waiting %d' % (
+        label, capacity, taken, registrations, waiting)
+    ok = True
+    if taken > capacity or registrations > taken:
+        print '  OVERSELL: more attendees than seats'
+        ok = False
+    if registrations < taken:
+        print '  LOST SEATS: %d seats taken without a registration' % (
+            taken - registrations)
+        ok = False
+    if promoted and free > 0 and waiting > 0:
+        print '  UNDERSELL: %d free seats with %d waiting' % (free, waiting)
+        ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--attendees', type=int, default=1000)
+    parser.add_argument('--capacity', type=int, default=500)
+    parser.add_argument('--shards', type=int, default=seats.NUM_SEAT_SHARDS)
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='share of attendees who unregister again')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    rng = random.Random(args.seed)
+    bed = sdk.testbedEnv(ORGANIZER)
+    try:
+        wsck = seedConference(args.capacity, args.shards)
+        conf_key = ndb.Key(urlsafe=wsck)
+        counter = TxnCounter()
+        counter.install()
+
+        jobs = Queue.Queue()
+        attendees = [ndb.Key(Profile, 'attendee%d@example.com' % i)
+                     for i in range(args.attendees)]
+        for p_key in attendees:
+            jobs.put((p_key, True))
+        # unregistrations are queued behind the registration storm
+        for p_key in rng.sample(attendees, int(args.attendees * args.churn)):
+            jobs.put((p_key, False))
+
+        results = []
+        threads = [threading.Thread(target=worker,
+                                    args=(jobs, results, wsck))
+                   for _ in range(args.workers)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        outcomes = collections.Counter(
+            ('register' if reg else 'unregister', outcome)
+            for reg, outcome, _ in results)
+        latencies = [ms for _, _, ms in results]
+        commits = counter.counts['Commit']
+        begins = counter.counts['BeginTransaction']
+        rollbacks = counter.counts['Rollback']
+        conflicts = counter.counts['Commit failed']
+        aborts = sum(n for (_, outcome), n in outcomes.items()
+                     if outcome not in (True, False))
+
+        print '%d calls by %d workers on %d shards in %.2fs' % (
+            len(results), args.workers, args.shards, elapsed)
+        for (kind, outcome), n in sorted(outcomes.items()):
+            print '  %-10s %-28s %6d' % (kind, outcome, n)
+        print 'commit rate      %.1f commits/s' % (commits / elapsed)
+        # a failed commit lost to a concurrent transaction on the same
+        # entity group; ndb retries it unless out of retries (an abort)
+        print 'transactions     %d begun, %d committed, %d rolled back, ' \
+              '%d commit conflicts' % (begins, commits, rollbacks, conflicts)
+        print 'aborts           %d' % aborts
+        print 'latency ms       p50 %.1f  p99 %.1f  max %.1f' % (
+            percentile(latencies, 50), percentile(latencies, 99),
+            max(latencies or [0]))
+
+        ok = check('after storm', conf_key, promoted=False)
+        # only queued tasks run, so a freed seat nobody scheduled a
+        # promotion for shows up as undersell
+        print 'promotion tasks  %d' % runPromotions(bed)
+        ok = check('after promotion', conf_key, promoted=True) and ok
+    finally:
+        bed.deactivate()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""bench_converters.py -- per-row cost of entity -> form copies.
+
+Compares the reflective all_fields() copy loop the API used to run for
+every row with the precompiled plans in converters.py. Entities are built
+in memory, so no datastore stub is needed.
+
+    APPENGINE_SDK=/path/to/google_appengine python benchmarks/bench_converters.py
+
+"""
+
+import timeit
+from datetime import date, time
+
+import sdk
+sdk.setup()
+
+from google.appengine.ext import ndb
+
+from converters import copyToForm
+from models import Conference, ConferenceForm
+from models import Session, SessionForm
+from models import Speaker, SpeakerForm
+from models import TypeOfSession
+
+ROWS = 1000
+REPEAT = 5
+
+
+def legacyConference(conf):
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    cf.check_initialized()
+    return cf
+
+
+def legacySession(sess):
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(sess, field.name):
+            if field.name.endswith('date'):
+                setattr(sf, field.name, str(getattr(sess, field.name)))
+            elif field.name.endswith('startTime'):
+                setattr(sf, field.name, str(getattr(sess, field.name)))
+            elif field.name.endswith('typeOfSession'):
+                setattr(sf, field.name,
+                        getattr(TypeOfSession, getattr(sess, field.name)))
+            else:
+                setattr(sf, field.name, getattr(sess, field.name))
+        elif field.name == "websafeKey":
+            setattr(sf, field.name, sess.key.urlsafe())
+    sf.check_initialized()
+    return sf
+
+
+def legacySpeaker(speaker):
+    sf = SpeakerForm()
+    for field in sf.all_fields():
+        if hasattr(speaker, field.name):
+            setattr(sf, field.name, getattr(speaker, field.name))
+        elif field.name == 'websafeKey':
+            setattr(sf, field.name, speaker.key.urlsafe())
+    sf.check_initialized()
+    return sf
+
+
+def makeRows():
+    conf_key = ndb.Key('Profile', 'bench@example.com', Conference, 1)
+    confs = [Conference(key=ndb.Key('Profile', 'bench@example.com',
+                                    Conference, i + 1),
+                        name='Conference %d' % i, description='x' * 200,
+                        organizerUserId='bench@example.com',
+                        topics=['Web', 'Cloud'], city='London',
+                        startDate=date(2015, 6, 1), month=6,
+                        endDate=date(2015, 6, 3), maxAttendees=100,
+                        seatsAvailable=40)
+             for i in range(ROWS)]
+    sessions = [Session(key=ndb.Key(Session, i + 1, parent=conf_key),
+                        name='Session %d' % i, highlights='y' * 100,
+                        speakerKeys=['a', 'b'], duration=60,
+                        typeOfSession='Lecture', date=date(2015, 6, 2),
+                        startTime=time(9, 30),
+                        websafeConferenceKey=conf_key.urlsafe())
+                for i in range(ROWS)]
+    speakers = [Speaker(key=ndb.Key(Speaker, i + 1), name='Speaker %d' % i,
+                        organization='Org', bio='z' * 300, rating=4)
+                for i in range(ROWS)]
+    return [('Conference', confs, legacyConference, ConferenceForm),
+            ('Session', sessions, legacySession, SessionForm),
+            ('Speaker', speakers, legacySpeaker, SpeakerForm)]
+
+
+def perRow(fn, rows):
+    """Best-of-REPEAT microseconds per row."""
+    best = min(timeit.repeat(lambda: [fn(row) for row in rows],
+                             number=1, repeat=REPEAT))
+    return best / len(rows) * 1e6
+
+
+def main():
+    print '%-12s %12s %12s %8s' % ('form', 'legacy us', 'plan us', 'speedup')
+    for name, rows, legacy, form_cls in makeRows():
+        # both paths must produce the same form
+        assert legacy(rows[0]) == copyToForm(rows[0], form_cls)
+        before = perRow(legacy, rows)
+        after = perRow(lambda row: copyToForm(row, form_cls), rows)
+        print '%-12s %12.1f %12.1f %7.1fx' % (
+            name, before, after, before / after)
+
+
+if __name__ == '__main__':
+    main()
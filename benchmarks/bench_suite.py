@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+"""bench_suite.py -- scenario benchmarks for ConferenceApi on the testbed.
+
+Seeds a synthetic data set (conferences, sessions, speakers, profiles)
+into the testbed stubs, then drives the ConferenceApi methods directly,
+one fresh service instance and signed-in user per call, as the endpoints
+server would. For every scenario it reports throughput, p50/p99 latency
+and the RPCs per call (per service, counted by instrumentation.py), and
+writes them as JSON so runs can be compared commit to commit:
+
+    APPENGINE_SDK=/path/to/google_appengine \\
+        python benchmarks/bench_suite.py --out baseline.json
+    python benchmarks/bench_suite.py --compare baseline.json
+
+The stubs answer in-process, so latencies measure the app's own CPU
+cost; RPC counts are what carries over to production.
+
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import subprocess
+import time
+from datetime import date, timedelta
+from datetime import time as timeOfDay
+
+import sdk
+from sdk import percentile
+sdk.setup()
+# the suite records its own per-scenario counts
+os.environ['INSTRUMENTATION'] = '0'
+
+from google.appengine.ext import ndb
+from protorpc import message_types
+
+import instrumentation
+import seats
+from conference import ConferenceApi
+from conference import CONF_GET_REQUEST
+from conference import FEAT_GET_SPEAKER
+from conference import SESS_POST_REQUEST
+from conference import SESS_POST_WISHLIST
+from conference import SPEC_GET
+from models import Conference
+from models import ConflictException
+from models import ConferenceQueryForm, ConferenceQueryForms
+from models import Profile
+from models import Session
+from models import SessionQueryForm, SessionQueryForms
+from models import Speaker
+from models import TypeOfSession
+
+CITIES = ('London', 'Chicago', 'Tokyo', 'Paris', 'Berlin', 'Sydney')
+TOPICS = ('Web', 'Cloud', 'Mobile', 'Data', 'Security', 'Design')
+SESSION_TYPES = ('Keynote', 'Lecture', 'Workshop', 'Demonstration')
+
+
+def userEmail(i):
+    return 'user%d@example.com' % i
+
+
+def organizerEmail(i):
+    return 'org%d@example.com' % i
+
+
+class DataSet(object):
+    """Websafe keys of the seeded entities."""
+
+    def __init__(self):
+        self.conferences = []
+        self.organizers = {}
+        self.sessions = []
+        self.speakers = []
+        self.users = []
+
+
+def seed(args, rng):
+    """Write the synthetic data set with put_multi; returns a DataSet."""
+    data = DataSet()
+    entities = []
+    speaker_keys = [ndb.Key(Speaker, i + 1) for i in range(args.speakers)]
+    for i, key in enumerate(speaker_keys):
+        entities.append(Speaker(key=key, name='Speaker %d' % i,
+                                organization='Org %d' % (i % 7),
+                                bio='bio', rating=rng.randint(1, 5)))
+    data.speakers = [key.urlsafe() for key in speaker_keys]
+
+    organizers = max(1, args.conferences // 5)
+    for i in range(organizers):
+        entities.append(Profile(key=ndb.Key(Profile, organizerEmail(i)),
+                                displayName='Organizer %d' % i,
+                                mainEmail=organizerEmail(i)))
+    for i in range(args.profiles):
+        entities.append(Profile(key=ndb.Key(Profile, userEmail(i)),
+                                displayName='User %d' % i,
+                                mainEmail=userEmail(i)))
+        data.users.append(userEmail(i))
+
+    start = date(2016, 1, 1)
+    for i in range(args.conferences):
+        org = organizerEmail(i % organizers)
+        p_key = ndb.Key(Profile, org)
+        begins = start + timedelta(days=rng.randint(0, 360))
+        capacity = rng.choice((0, 50, 200, 1000))
+        conf = Conference(
+            key=ndb.Key(Conference, i + 1, parent=p_key),
+            name='Conference %d' % i, description='desc',
+            organizerUserId=org, city=rng.choice(CITIES),
+            topics=rng.sample(TOPICS, 2), startDate=begins,
+            month=begins.month, endDate=begins + timedelta(days=2),
+            maxAttendees=capacity,
+            seatsAvailable=capacity - rng.randint(0, capacity // 2))
+        entities.append(conf)
+        if capacity:
+            entities.extend(seats.newShards(conf))
+        wsck = conf.key.urlsafe()
+        data.conferences.append(wsck)
+        data.organizers[wsck] = org
+        for j in range(args.sessions):
+            sess = Session(
+                key=ndb.Key(Session, j + 1, parent=conf.key),
+                name='Session %d.%d' % (i, j), highlights='',
+                speakerKeys=[rng.choice(data.speakers)], duration=60,
+                typeOfSession=rng.choice(SESSION_TYPES),
+                date=begins + timedelta(days=j % 3),
+                startTime=timeOfDay(rng.choice((9, 11, 14, 16, 19))),
+                websafeConferenceKey=wsck)
+            entities.append(sess)
+            data.sessions.append(sess.key.urlsafe())
+    for i in range(0, len(entities), 500):
+        ndb.put_multi(entities[i:i + 500])
+    return data
+
+
+def signIn(email):
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['USER_EMAIL'] = email
+
+
+def newRequest():
+    """Start a simulated request: empty the ndb in-context cache and
+    return a fresh service instance."""
+    ndb.get_context().clear_cache()
+    return ConferenceApi()
+
+
+def scenarios(data, rng):
+    """Return (name, operation) pairs; each operation runs one call."""
+    users = iter(rng.sample(data.users, len(data.users)))
+    capped = [wsck for wsck in data.conferences
+              if ndb.Key(urlsafe=wsck).get().maxAttendees]
+
+    def register():
+        # a new attendee per call while they last (see --profiles)
+        signIn(next(users, rng.choice(data.users)))
+        newRequest().registerForConference(
+            CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=rng.choice(capped)))
+
+    def getConference():
+        signIn(rng.choice(data.users))
+        newRequest().getConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=rng.choice(data.conferences)))
+
+    def queryConferences():
+        signIn(rng.choice(data.users))
+        filters = [ConferenceQueryForm(field='CITY', operator='EQ',
+                                       value=rng.choice(CITIES))]
+        if rng.random() < 0.5:
+            filters.append(ConferenceQueryForm(
+                field='TOPIC', operator='EQ', value=rng.choice(TOPICS)))
+        if rng.random() < 0.5:
+            filters.append(ConferenceQueryForm(
+                field='MONTH', operator='EQ', value=str(rng.randint(1, 12))))
+        newRequest().queryConferences(ConferenceQueryForms(filters=filters))
+
+    def querySessions():
+        # date and time filters reach the datastore as the plan's
+        # pushed-down filter
+        signIn(rng.choice(data.users))
+        if rng.random() < 0.5:
+            day = date(2016, 1, 1) + timedelta(days=rng.randint(0, 362))
+            filters = [SessionQueryForm(field='DATE', operator='EQ',
+                                        value=str(day))]
+        else:
+            filters = [SessionQueryForm(
+                field='START_TIME', operator=rng.choice(('LT', 'GTEQ')),
+                value=rng.choice(('1000', '1400', '1800')))]
+        newRequest().querySessions(SessionQueryForms(filters=filters))
+
+    def wishlist():
+        signIn(rng.choice(data.users))
+        api = newRequest()
+        try:
+            api.addSessionToWishlist(
+                SESS_POST_WISHLIST.combined_message_class(
+                    websafeSessionKey=rng.choice(data.sessions)))
+        except ConflictException:
+            # already on the wishlist
+            pass
+        api.getSessionsInWishlist(message_types.VoidMessage())
+
+    def featuredSpeaker():
+        wsck = rng.choice(data.conferences)
+        signIn(data.organizers[wsck])
+        api = newRequest()
+        api.createSession(SESS_POST_REQUEST.combined_message_class(
+            websafeConferenceKey=wsck, name='Extra session',
+            speakerKeys=[rng.choice(data.speakers)],
+            typeOfSession=TypeOfSession.Lecture, duration=30))
+        # run the featured speaker task inline
+        ConferenceApi._cacheSpeaker({})
+        api.getFeaturedSpeaker(FEAT_GET_SPEAKER.combined_message_class(
+            websafeConferenceKey=wsck))
+
+    def percentFull():
+        signIn(rng.choice(data.users))
+        newRequest().getPercentFullConf(SPEC_GET.combined_message_class(
+            operator='GT', value=rng.choice((10, 25, 50))))
+
+    return [('register', register),
+            ('getConference', getConference),
+            ('queryConferences', queryConferences),
+            ('querySessions', querySessions),
+            ('wishlist', wishlist),
+            ('featuredSpeaker', featuredSpeaker),
+            ('percentFull', percentFull)]
+
+
+def run(name, operation, ops):
+    """Run operation ops times; return its metrics dict."""
+    latencies = []
+    rpcs = {}
+    read = written = errors = 0
+    started = time.time()
+    for _ in range(ops):
+        with instrumentation.recording(name) as record:
+            try:
+                operation()
+            except Exception:
+                logging.exception('%s failed', name)
+                errors += 1
+        latencies.append(record.ms)
+        for service, n in record.rpcs.items():
+            rpcs[service] = rpcs.get(service, 0) + n
+        read += record.read
+        written += record.written
+    elapsed = time.time() - started
+    return {
+        'ops': ops, 'errors': errors,
+        'throughput': round(ops / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'rpcs_per_op': dict((service, round(n / float(ops), 2))
+                            for service, n in sorted(rpcs.items())),
+        'entities_read_per_op': round(read / float(ops), 2),
+        'entities_written_per_op': round(written / float(ops), 2),
+    }
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=sdk.APP_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    print '%-18s %9s %9s %9s %8s  %s' % (
+        'scenario', 'ops/s', 'p50 ms', 'p99 ms', 'rpcs/op', 'vs baseline')
+    for name, metrics in results.items():
+        total = sum(metrics['rpcs_per_op'].values())
+        change = ''
+        old = (baseline or {}).get(name)
+        if old:
+            old_total = sum(old['rpcs_per_op'].values())
+            change = 'p50 %+.0f%%, rpcs %+.2f' % (
+                100.0 * (metrics['p50_ms'] - old['p50_ms']) /
+                (old['p50_ms'] or 1), total - old_total)
+        print '%-18s %9s %9.2f %9.2f %8.2f  %s' % (
+            name, metrics['throughput'], metrics['p50_ms'],
+            metrics['p99_ms'], total, change)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--conferences', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=50)
+    parser.add_argument('--profiles', type=int, default=500)
+    parser.add_argument('--ops', type=int, default=200,
+                        help='calls per scenario')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenario', action='append',
+                        help='run only these scenarios')
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare with')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    bed = sdk.testbedEnv(userEmail(0))
+    try:
+        started = time.time()
+        data = seed(args, rng)
+        seeded = time.time() - started
+        results = collections.OrderedDict()
+        for name, operation in scenarios(data, rng):
+            if args.scenario and name not in args.scenario:
+                continue
+            results[name] = run(name, operation, args.ops)
+    finally:
+        bed.deactivate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['scenarios']
+    report(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'revision': gitRevision(), 'created': time.time(),
+                       'seed_seconds': round(seeded, 2),
+                       'scale': {'conferences': args.conferences,
+                                 'sessions': args.sessions,
+                                 'speakers': args.speakers,
+                                 'profiles': args.profiles,
+                                 'ops': args.ops, 'seed': args.seed},
+                       'scenarios': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
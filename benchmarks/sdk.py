@@ -0,0 +1,58 @@
+"""sdk.py -- put the App Engine SDK and the app on sys.path for the
+benchmark scripts, and the testbed and statistics helpers they share.
+
+Set APPENGINE_SDK to the SDK directory (the one containing
+dev_appserver.py) if it is not already importable.
+
+"""
+
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup():
+    """Make google.appengine, endpoints, protorpc and the app importable."""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk and sdk not in sys.path:
+        sys.path.insert(0, sdk)
+    try:
+        import dev_appserver
+    except ImportError:
+        sys.exit('App Engine SDK not found; set APPENGINE_SDK')
+    dev_appserver.fix_sys_path()
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    os.environ.setdefault('APPLICATION_ID', 'dev~conference-bench')
+
+
+def testbedEnv(email='bench@example.com'):
+    """Activate a testbed with in-memory datastore, memcache and task
+    queue stubs, signed in (for endpoints) as email. Call setup() first;
+    returns the Testbed, deactivate() it when done."""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(user_email=email, user_id=email, overwrite=True)
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+    # every write applies at once so queries see fixture data
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_user_stub()
+    bed.init_urlfetch_stub()
+    return bed
+
+
+def percentile(samples, p):
+    """Return the p-th percentile of samples (0.0 if there are none)."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
@@ -15,16 +15,22 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime
 
+import hashlib
+import json
+import logging
 import operator
 import endpoints
 import collections
 
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import *
@@ -36,13 +42,37 @@ from settings import ANDROID_AUDIENCE
 
 from utils import *
 
+from converters import copyToForm
+from instrumentation import instrumented
+
+import attendance
+import seats
+import waitlist
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_SEATS = 5
+ANNOUNCEMENT_INDEX_ID = 'nearly-sold-out'
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER_"
 FEATURED_SPEAKER_TPL = ('Featured speaker: %s\nSessions: %s')
+FEATURED_SPEAKER_QUEUE = 'featured-speaker'
+FEATURED_SPEAKER_DELAY = 5
+FEATURED_SPEAKER_LEASE = 60
+FEATURED_SPEAKER_BATCH = 1000
+MEMCACHE_CONFERENCE_FORM_KEY = "CONFERENCE_FORM_"
+MEMCACHE_SESSION_FORM_KEY = "SESSION_FORM_"
+MEMCACHE_SPEAKER_FORM_KEY = "SPEAKER_FORM_"
+MEMCACHE_SCHEDULE_KEY = "SCHEDULE_"
+FORM_CACHE_TTL = 600
+MEMCACHE_CONFERENCE_QUERY_KEY = "CONFERENCE_QUERY_"
+QUERY_CACHE_TTL = 300
+MAX_SESSIONS_PER_REQUEST = 500
+WAITLIST_PROMOTE_BATCH = 20
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -77,11 +107,41 @@ FIELDS = {
         'MAX_ATTENDEES': 'maxAttendees',
         }
 
+# session query fields: (property, value parser)
+SESSION_FIELDS = {
+        'TYPE': ('typeOfSession', str),
+        'SPEAKER': ('speakerKeys', str),
+        'DATE': ('date',
+                 lambda v: datetime.strptime(v[:10], "%Y-%m-%d").date()),
+        'START_TIME': ('startTime',
+                       lambda v: datetime.strptime(v[:4], "%H%M").time()),
+        'DURATION': ('duration', int),
+        }
+
+# rough selectivity of equality filters, most selective first; the
+# session query planner sends the best one to the datastore
+SESSION_SELECTIVITY = ['speakerKeys', 'date', 'startTime',
+                       'typeOfSession', 'duration']
+SESSION_SCAN_BATCH = 100
+
+# properties loaded by projection queries when a list request asks only
+# for these fields; each projection has a matching index in index.yaml
+CONFERENCE_PROJECTION = ('name', 'city', 'startDate', 'endDate',
+                         'maxAttendees', 'seatsAvailable',
+                         'organizerUserId')
+SPEAKER_PROJECTION = ('name', 'organization', 'rating')
+MAX_SESSION_SCAN = 1000
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -90,6 +150,8 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
     )
 
 SESS_POST_REQUEST = endpoints.ResourceContainer(
@@ -97,15 +159,24 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESS_POST_MULTI = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(3),
+)
+
 SESS_GET_TYPE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
 )
 
 SESS_GET_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSpeakerKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
 )
 
 SESS_POST_WISHLIST = endpoints.ResourceContainer(
@@ -118,24 +189,46 @@ SESS_GET_WISHLIST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    )
+
 SPEC_GET = endpoints.ResourceContainer(
     message_types.VoidMessage,
     value=messages.IntegerField(1),
-    operator=messages.StringField(2))
+    operator=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4))
 
 SESS_POST_DOUBLE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     time=messages.StringField(1),
-    sess_type=messages.StringField(2))
+    sess_type=messages.StringField(2),
+    websafeConferenceKey=messages.StringField(3),
+    pageSize=messages.IntegerField(4, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(5))
 
 FEAT_GET_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1))
 
+SESS_GET_SESSION = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1))
+
 SPK_GET_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSpeakerKey=messages.StringField(1))
 
+SPK_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True))
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -148,33 +241,109 @@ SPK_GET_SPEAKER = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    # the service is instantiated once per request, so these memoize
+    # the caller's identity and Profile for the request only
+    _identity = None
+    _profile = None
+
+# - - - Paging - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _pageParams(self, request):
+        """Return (page size, start Cursor or None) for request."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 0:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be positive.")
+        page_size = min(page_size, MAX_PAGE_SIZE)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException(
+                    'Invalid pageToken: %s' % request.pageToken)
+        return page_size, cursor
+
+    def _listOptions(self, fields, form_cls, projection):
+        """Return (query options, field names or None) for a list
+        request's optional fields selector.
+
+        Only websafeKey -> keys-only query; fields all covered by the
+        projection -> projection query; anything else loads entities.
+        Pass projection=None where no projection index exists.
+        """
+        if not fields:
+            return {}, None
+        names = set(fields)
+        unknown = names - set(f.name for f in form_cls.all_fields())
+        if unknown:
+            raise endpoints.BadRequestException(
+                'Unknown fields: %s' % ', '.join(sorted(unknown)))
+        if names == set(['websafeKey']):
+            return {'keys_only': True}, names
+        # organizer names are looked up from organizerUserId
+        if projection and (names - set(['websafeKey',
+                                        'organizerDisplayName']) <=
+                           set(projection)):
+            return {'projection': projection}, names
+        return {}, names
+
+    def _fetchPage(self, query, request, **options):
+        """Return (results, nextPageToken) for one page of query.
+
+        request.pageSize defaults to DEFAULT_PAGE_SIZE and is capped at
+        MAX_PAGE_SIZE; request.pageToken is the websafe cursor handed out
+        with the previous page. nextPageToken is None on the last page.
+        """
+        page_size, cursor = self._pageParams(request)
+        results, next_cursor, more = query.fetch_page(
+            page_size, start_cursor=cursor, **options)
+        if more and next_cursor:
+            return results, next_cursor.urlsafe()
+        return results, None
+
+# - - - Form cache - - - - - - - - - - - - - - - - - - - - -
+
+    def _getCachedForm(self, prefix, form_cls, websafeKey, load):
+        """Return the form for websafeKey, read through memcache.
+
+        On a miss load(websafeKey) builds the form (raising if the entity
+        does not exist) and it is cached for FORM_CACHE_TTL seconds.
+        """
+        memcache_key = prefix + websafeKey
+        cached = memcache.get(memcache_key)
+        if cached is not None:
+            return protojson.decode_message(form_cls, cached)
+        form = load(websafeKey)
+        self._cacheForm(prefix, websafeKey, form)
+        return form
+
+    def _cacheForm(self, prefix, websafeKey, form):
+        """Store a serialized form in memcache."""
+        memcache.set(prefix + websafeKey, protojson.encode_message(form),
+                     time=FORM_CACHE_TTL)
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None,
+                              fields=None):
+        """Copy relevant fields from Conference to ConferenceForm;
+        seatsAvailable overrides the (periodically synced) stored count
+        and fields limits the copy to those form fields."""
+        cf = copyToForm(conf, ConferenceForm, fields)
+        if displayName and (fields is None or
+                            'organizerDisplayName' in fields):
             setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+        if seatsAvailable is not None:
+            cf.seatsAvailable = seatsAvailable
+            cf.percentFull = computePercentFull(
+                seatsAvailable, conf.maxAttendees)
         return cf
 
     def _createConferenceObject(self, request):
         """Create or update Conference object """
         # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException(
-                'Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._currentUser()
 
         if not request.name:
             raise endpoints.BadRequestException(
@@ -185,6 +354,7 @@ class ConferenceApi(remote.Service):
             request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['percentFull']
 
         # add default values for those missing
         # (both data model & outbound Message)
@@ -215,21 +385,20 @@ class ConferenceApi(remote.Service):
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        # create Conference and its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        conf = Conference(**data)
+        shards = seats.newShards(conf) if data["seatsAvailable"] > 0 else []
+        ndb.put_multi([conf] + shards)
+        bumpConferenceGeneration()
         taskqueue.add(params={'email': user.email(),
                               'conferenceInfo': repr(request)},
                       url='/tasks/send_confirmation_email')
         return request
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException(
-                'Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._currentUser()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(
@@ -250,7 +419,19 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        # seats follow maxAttendees; the shard counters hold the rest,
+        # so leave them (and their entity groups) alone unless it changed
+        if (request.maxAttendees is not None and
+                request.maxAttendees != conf.maxAttendees):
+            if request.maxAttendees > conf.maxAttendees:
+                # new seats go to anyone waiting
+                waitlist.schedulePromotion(conf.key.urlsafe(),
+                                           transactional=True)
+            seats.resize(conf, request.maxAttendees)
         for field in request.all_fields():
+            # percentFull is computed from the seat counts on put()
+            if field.name in ('percentFull', 'seatsAvailable'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -263,11 +444,12 @@ class ConferenceApi(remote.Service):
                 setattr(conf, field.name, data)
         conf.put()
         prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return conf, prof
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST',
                       name='createConference')
+    @instrumented
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -276,53 +458,91 @@ class ConferenceApi(remote.Service):
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT',
                       name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        conf, prof = self._updateConferenceObject(request)
+        # drop cached copies only once the update has committed
+        memcache.delete(
+            MEMCACHE_CONFERENCE_FORM_KEY + request.websafeConferenceKey)
+        seats.forgetSeats(conf.key)
+        bumpConferenceGeneration()
+        # report the live seat count, as getConference does; the stored
+        # one lags until the next sync
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'),
+                                        seats.seatsAvailable(conf))
+        # a new capacity or name may change the announcement
+        self._setNearlySoldOut({request.websafeConferenceKey: cf.name if
+                                self._nearlySoldOut(cf.seatsAvailable)
+                                else None})
+        return cf
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET',
                       name='getConference')
+    @instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        return self._getCachedForm(
+            MEMCACHE_CONFERENCE_FORM_KEY, ConferenceForm,
+            request.websafeConferenceKey, self._loadConferenceForm)
+
+    def _loadConferenceForm(self, websafeConferenceKey):
+        """Build the ConferenceForm served by getConference."""
+        return self._loadConferenceFormAsync(
+            websafeConferenceKey).get_result()
+
+    @ndb.tasklet
+    def _loadConferenceFormAsync(self, websafeConferenceKey):
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        # the organizer Profile is the conference's parent, so get
+        # both at once; bail if the conference is not found
+        conf, prof = yield conf_key.get_async(), conf_key.parent().get_async()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s'
-                % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(
-            conf, getattr(prof, 'displayName'))
+                % websafeConferenceKey)
+        # return ConferenceForm with the live seat count
+        raise ndb.Return(self._copyConferenceToForm(
+            conf, getattr(prof, 'displayName', None),
+            seats.seatsAvailable(conf)))
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST',
                       name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException(
-                'Authorization required')
-        user_id = getUserId(user)
+        user, user_id = self._currentUser()
 
+        options, fields = self._listOptions(
+            request.fields, ConferenceForm, CONFERENCE_PROJECTION)
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = Conference.query(
+            ancestor=ndb.Key(Profile, user_id)).fetch(**options)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(
-                prof, 'displayName')) for conf in confs]
-        )
+            items=self._conferenceListForms(confs, options, fields))
+
+    def _getOrganizerNames(self, conferences):
+        """Return dict of organizerUserId -> displayName for conferences.
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+        Each organizer Profile is fetched once with a single get_multi;
+        organizers without a Profile are left out of the dict.
+        """
+        user_ids = set(conf.organizerUserId for conf in conferences
+                       if conf.organizerUserId)
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, user_id) for user_id in user_ids])
+        return dict((prof.key.id(), prof.displayName)
+                    for prof in profiles if prof)
+
+    def _getQuery(self, inequality_filter, filters):
+        """Return formatted query from the formatted filters."""
         q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
@@ -330,10 +550,10 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        # key order keeps cursors usable for '!=' (multi-query) filters
+        q = q.order(Conference.key)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(
                 filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
@@ -355,6 +575,14 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "'%s' filter value must be a number."
+                        % filtr["field"])
+
             # Every operation except "=" is an inequality
             if filtr["operator"] != "=":
                 # check if inequality operation has been used in previous filters
@@ -373,61 +601,99 @@ class ConferenceApi(remote.Service):
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        # organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        # profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        # names = {}
-        # for profile in profiles:
-        #    names[profile.key.id()] = profile.displayName
+        inequality_filter, filters = self._formatFilters(request.filters)
+        # filtered plans would each need their own projection index,
+        # so only the unfiltered listing uses a projection
+        options, fields = self._listOptions(
+            request.fields, ConferenceForm,
+            None if request.filters else CONFERENCE_PROJECTION)
+
+        # the same searches come in over and over; serve repeats from
+        # memcache until the next conference write
+        cache_key = self._queryCacheKey(filters, request)
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            return protojson.decode_message(ConferenceForms, cached)
+
+        conferences, next_page = self._fetchPage(
+            self._getQuery(inequality_filter, filters), request, **options)
 
         # return individual ConferenceForm object per Conference
-        # return ConferenceForms(
-        #      items=[self._copyConferenceToForm(
-        #            conf, names[conf.organizerUserId]) for conf in \
-        #      conferences])
-        
-        # activating this code seems to cause an error
-
-        return ConferenceForms(items=[
-            self._copyConferenceToForm(conf, "")
-            for conf in conferences])
+        forms = ConferenceForms(
+            items=self._conferenceListForms(conferences, options, fields),
+            nextPageToken=next_page)
+        memcache.set(cache_key, protojson.encode_message(forms),
+                     time=QUERY_CACHE_TTL)
+        return forms
+
+    def _queryCacheKey(self, filters, request):
+        """Return the result cache key of a queryConferences request.
+
+        Filters are canonicalized (sorted, duplicates dropped, values
+        already coerced by _formatFilters), so the same search in any
+        order shares one entry. The key includes the generation, which
+        bumpConferenceGeneration moves on every conference write.
+        """
+        page_size, _ = self._pageParams(request)
+        canonical = json.dumps([
+            sorted(set((f["field"], f["operator"], f["value"])
+                       for f in filters)),
+            page_size, request.pageToken, sorted(set(request.fields))])
+        return '%s%d_%s' % (MEMCACHE_CONFERENCE_QUERY_KEY,
+                            conferenceGeneration(),
+                            hashlib.sha1(canonical).hexdigest())
+
+    def _conferenceListForms(self, conferences, options, fields):
+        """Return (possibly sparse) ConferenceForms for a listing."""
+        if options.get('keys_only'):
+            return [ConferenceForm(websafeKey=key.urlsafe())
+                    for key in conferences]
+        # need to fetch organiser displayName from profiles;
+        # one get_multi for all organisers on this listing
+        names = {}
+        if fields is None or 'organizerDisplayName' in fields:
+            names = self._getOrganizerNames(conferences)
+        return [self._copyConferenceToForm(
+            conf, names.get(conf.organizerUserId), fields=fields)
+            for conf in conferences]
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name,
-                        getattr(TeeShirtSize,
-                            getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
+        # t-shirt string is converted to Enum by the converter
+        pf = copyToForm(prof, ProfileForm)
+        # the lists now live in child entities of the Profile
+        pf.conferenceKeysToAttend, pf.sessionWishlistKeys = \
+            attendance.attendanceKeys(prof.key)
         return pf
 
+    def _currentUser(self):
+        """Return (user, user_id) of the caller, looked up once per
+        request; raises UnauthorizedException if not signed in."""
+        if self._identity is None:
+            user = endpoints.get_current_user()
+            if not user:
+                raise endpoints.UnauthorizedException(
+                    'Authorization required')
+            self._identity = user, getUserId(user)
+        return self._identity
+
     def _getProfileFromUser(self):
         """Return user Profile from datastore,
         creating new one if non-existent."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException(
-                'Authorization required')
+        user, user_id = self._currentUser()
+        # reuse this request's Profile, except inside a transaction,
+        # which must read (and so lock) the entity itself
+        in_txn = ndb.in_transaction()
+        if self._profile is not None and not in_txn:
+            return self._profile
 
         # get Profile from datastore
-        user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
         # create new Profile if not there
@@ -438,6 +704,11 @@ class ConferenceApi(remote.Service):
                         mainEmail    = user.email(),
                         teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),)
             profile.put()
+        # move any old attendance lists into child entities
+        elif attendance.needsMigration(profile):
+            profile = attendance.migrateProfile(p_key)
+        if not in_txn:
+            self._profile = profile
         # return Profile
         return profile
 
@@ -466,6 +737,7 @@ class ConferenceApi(remote.Service):
                       path='profile',
                       http_method='GET',
                       name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -474,6 +746,7 @@ class ConferenceApi(remote.Service):
                       path='profile',
                       http_method='POST',
                       name='saveProfile')
+    @instrumented
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -481,118 +754,254 @@ class ConferenceApi(remote.Service):
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+    def _nearlySoldOut(seatsLeft):
+        return 0 < (seatsLeft or 0) <= ANNOUNCEMENT_SEATS
 
-        if confs:
+    @staticmethod
+    def _setAnnouncement(conferences):
+        """Format the announcement for a websafeConferenceKey -> name
+        dict & assign to memcache."""
+        announcement = ""
+        if conferences:
             # If there are almost sold out conferences,
-            # format announcement and set it in memcache
+            # format announcement
             announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
+                ', '.join(sorted(conferences.values())))
+        # an empty announcement is cached too, so getAnnouncement only
+        # reads the datastore after an eviction
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         return announcement
 
+    @staticmethod
+    @ndb.transactional
+    def _storeNearlySoldOut(changes):
+        """Apply websafeConferenceKey -> name (None: remove) changes to
+        the AnnouncementIndex; returns the new set, None if unchanged."""
+        key = ndb.Key(AnnouncementIndex, ANNOUNCEMENT_INDEX_ID)
+        index = key.get() or AnnouncementIndex(key=key)
+        stored = index.conferences or {}
+        conferences = dict(stored)
+        for wsck, name in changes.items():
+            if name is None:
+                conferences.pop(wsck, None)
+            else:
+                conferences[wsck] = name
+        if conferences == stored:
+            return None
+        index.conferences = conferences
+        index.put()
+        return conferences
+
+    @staticmethod
+    def _setNearlySoldOut(changes):
+        """Update the nearly sold out set; the announcement is rebuilt
+        only if the set actually changed."""
+        conferences = ConferenceApi._storeNearlySoldOut(changes)
+        if conferences is not None:
+            ConferenceApi._setAnnouncement(conferences)
+
+    @staticmethod
+    def _seatsChanged(conf, delta):
+        """Record a committed change of delta seats at conf; moves conf
+        in or out of the announcement when it crosses the threshold."""
+        total = seats.seatsChanged(conf.key, delta)
+        if total is None:
+            total = seats.seatsAvailable(conf)
+        nearly = ConferenceApi._nearlySoldOut(total)
+        if nearly != ConferenceApi._nearlySoldOut(total - delta):
+            ConferenceApi._setNearlySoldOut(
+                {conf.key.urlsafe(): conf.name if nearly else None})
+
+    @staticmethod
+    def _cacheAnnouncement():
+        """Check the nearly sold out set against the conferences & reset
+        the memcache announcement; used by the cron job. Seat changes
+        keep the set current, so this only repairs drift (e.g. data
+        imported directly) and memcache evictions.
+        """
+        key = ndb.Key(AnnouncementIndex, ANNOUNCEMENT_INDEX_ID)
+        index = key.get()
+        stored = (index and index.conferences) or {}
+        # candidates: the stored set plus whatever the rolled-up counts
+        # say is nearly sold out (keys only)
+        conf_keys = set(ndb.Key(urlsafe=wsck) for wsck in stored)
+        conf_keys.update(Conference.query(ndb.AND(
+            Conference.seatsAvailable <= ANNOUNCEMENT_SEATS,
+            Conference.seatsAvailable > 0)).fetch(keys_only=True))
+        # decide on the live seat counts
+        changes = {}
+        for conf in ndb.get_multi(list(conf_keys)):
+            if conf and ConferenceApi._nearlySoldOut(
+                    seats.seatsAvailable(conf)):
+                changes[conf.key.urlsafe()] = conf.name
+        for wsck in stored:
+            changes.setdefault(wsck, None)
+        conferences = ConferenceApi._storeNearlySoldOut(changes)
+        if conferences is None:
+            conferences = stored
+        return ConferenceApi._setAnnouncement(conferences)
+
+    @staticmethod
+    def _backfillPercentFull(cursor=None, batch_size=100):
+        """Re-put one batch of Conferences so percentFull gets stored;
+        used by the backfill task. Returns the cursor to continue from,
+        or None when every Conference has been written.
+        """
+        if cursor:
+            cursor = Cursor(urlsafe=cursor)
+        confs, next_cursor, more = Conference.query().fetch_page(
+            batch_size, start_cursor=cursor)
+        ndb.put_multi(confs)
+        bumpConferenceGeneration()
+        if more and next_cursor:
+            return next_cursor.urlsafe()
+        return None
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET',
                       name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if announcement is None:
+            # evicted (or never set): rebuild from the stored set
+            index = ndb.Key(AnnouncementIndex, ANNOUNCEMENT_INDEX_ID).get()
+            announcement = self._setAnnouncement(
+                index and index.conferences)
+        return StringMessage(data=announcement)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
         prof = self._getProfileFromUser()  # get user Profile
+        return self._changeRegistration(
+            prof.key, request.websafeConferenceKey, reg)
 
+    def _changeRegistration(self, p_key, wsck, reg=True):
+        """Register or unregister the Profile p_key for a conference;
+        returns BooleanMessage (False: waitlisted / was not registered).
+        """
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
-        wsck = request.websafeConferenceKey
         conf = ndb.Key(urlsafe=wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        registered = attendance.isRegistered(p_key, wsck)
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registered:
                 raise ConflictException(
                     "You have already registered for this conference")
+            # free seats go to the waitlist first
+            if waitlist.hasWaiters(conf.key):
+                return self._joinWaitlist(conf, p_key, wsck)
+        # unregister (or leave the waitlist)
+        elif not registered:
+            return BooleanMessage(data=waitlist.leave(p_key, wsck))
+
+        # older conferences are moved onto seat shards on first use;
+        # conferences without seats never get any
+        if conf.maxAttendees > 0 or conf.seatsAvailable > 0:
+            conf = seats.ensureShards(conf)
+
+        # try shards in random order until one has a seat to give/take
+        for shard_key in seats.candidateShards(conf, taking=reg):
+            retval = self._moveSeat(p_key, wsck, shard_key, reg)
+            if retval is not None:
+                break
+        else:
+            # no seats avail: wait in line rather than retrying
+            if reg:
+                return self._joinWaitlist(conf, p_key, wsck)
+            # no shard holds this attendee's seat; still unregister
+            shard_key = None
+            retval = self._moveSeat(p_key, wsck, shard_key, reg)
+
+        if retval and shard_key:
+            self._seatsChanged(conf, -1 if reg else 1)
+            memcache.delete(MEMCACHE_CONFERENCE_FORM_KEY + wsck)
+        return BooleanMessage(data=retval)
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+    def _joinWaitlist(self, conf, p_key, wsck):
+        """Queue the user for a seat; registration returns False."""
+        waitlist.join(p_key, wsck)
+        waitlist.forgetPosition(p_key, wsck)
+        # a seat freed while joining may have found the line empty, so
+        # make sure one is not left free while this user waits
+        if seats.seatsAvailable(conf) > 0:
+            waitlist.ensurePromotion(wsck)
+        return BooleanMessage(data=False)
 
+    @ndb.transactional(xg=True)
+    def _moveSeat(self, p_key, wsck, shard_key, reg):
+        """Move one seat between a conference's shard and the user's
+        Registration. Returns None if the shard cannot be used. A seat
+        given back is handed on to the waitlist by a task enqueued with
+        the transaction (it does nothing if no one is waiting)."""
+        reg_key = attendance.registrationKey(p_key, wsck)
+        # re-check inside the transaction
+        registered = reg_key.get() is not None
+        if reg:
+            if registered:
+                raise ConflictException(
+                    "You have already registered for this conference")
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
-
-        # unregister
+            if not seats.takeSeat(shard_key):
+                return None
+            attendance.newRegistration(p_key, wsck).put()
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
-
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
-
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+            if not registered:
+                return False
+            # unregister user, add back one seat
+            if shard_key and not seats.releaseSeat(shard_key):
+                return None
+            reg_key.delete()
+            if shard_key:
+                waitlist.schedulePromotion(wsck, transactional=True)
+        return True
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET',
                       name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conf_keys = [ndb.Key(urlsafe=reg_key.id()) for reg_key in
+                     attendance.conferenceKeysAsync(prof.key).get_result()]
+        # organizers are the conferences' parent Profiles, so fetch
+        # them alongside the conferences instead of after
+        conf_futures = ndb.get_multi_async(conf_keys)
+        org_futures = ndb.get_multi_async(
+            set(key.parent() for key in conf_keys))
+        # skip conferences that have been deleted since registering
+        conferences = [f.get_result() for f in conf_futures]
+        conferences = [conf for conf in conferences if conf]
 
         # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
         names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        for org_future in org_futures:
+            organizer = org_future.get_result()
+            if organizer:
+                names[organizer.key.id()] = organizer.displayName
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(items=[
             self._copyConferenceToForm(
-                conf, names[conf.organizerUserId]) for conf in conferences])
+                conf, names.get(conf.organizerUserId)) for conf in conferences])
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST',
                       name='registerForConference')
+    @instrumented
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -601,14 +1010,107 @@ class ConferenceApi(remote.Service):
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE',
                       name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _promoteWaiter(p_key, wsck, shard_key):
+        """Move a waiter onto a seat from shard_key. Returns None if the
+        shard cannot be used, else the seats taken: 1, or 0 if they are
+        no longer waiting or already registered (entry removed)."""
+        entry_key = waitlist.entryKey(p_key, wsck)
+        if entry_key.get() is None:
+            return 0
+        taken = 0
+        reg_key = attendance.registrationKey(p_key, wsck)
+        if reg_key.get() is None:
+            if not seats.takeSeat(shard_key):
+                return None
+            attendance.newRegistration(p_key, wsck).put()
+            taken = 1
+        entry_key.delete()
+        return taken
+
+    @staticmethod
+    def _promoteWaitlist(wsck):
+        """Give free seats to waiters, oldest first; used by the
+        /tasks/promote_waitlist task. Re-queues itself while a full
+        batch was promoted."""
+        conf_key = ndb.Key(urlsafe=wsck)
+        conf = conf_key.get()
+        if not conf or not (conf.maxAttendees > 0 or
+                            conf.seatsAvailable > 0):
+            return
+        conf = seats.ensureShards(conf)
+        entries = waitlist.waiters(conf_key, WAITLIST_PROMOTE_BATCH)
+        promoted = 0
+        for entry in entries:
+            p_key = entry.key.parent()
+            moved = None
+            for shard_key in seats.candidateShards(conf):
+                moved = ConferenceApi._promoteWaiter(p_key, wsck, shard_key)
+                if moved is not None:
+                    break
+            if moved is None:
+                # no free seats left
+                break
+            waitlist.forgetPosition(p_key, wsck)
+            promoted += moved
+        else:
+            if len(entries) == WAITLIST_PROMOTE_BATCH:
+                waitlist.schedulePromotion(wsck)
+        if promoted:
+            ConferenceApi._seatsChanged(conf, -promoted)
+            memcache.delete(MEMCACHE_CONFERENCE_FORM_KEY + wsck)
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='GET',
+                      name='getWaitlistPosition')
+    @instrumented
+    def getWaitlistPosition(self, request):
+        """Return the user's place on a conference's waitlist (0 if not
+        waiting); memcached briefly, so poll this, not registration."""
+        user, user_id = self._currentUser()
+        if not request.websafeConferenceKey:
+            raise endpoints.BadRequestException(
+                "websafeConferenceKey required")
+        return WaitlistForm(position=waitlist.position(
+            ndb.Key(Profile, user_id), request.websafeConferenceKey))
+
+    def _copyAttendeeToForm(self, registration, prof):
+        """Copy an attendee's Registration and Profile to AttendeeForm."""
+        return AttendeeForm(
+            displayName=getattr(prof, 'displayName', None),
+            # Profile ids are the users' emails
+            mainEmail=getattr(prof, 'mainEmail', None) or
+            registration.key.parent().id(),
+            registered=str(registration.created))
+
+    @endpoints.method(ATTENDEES_GET_REQUEST, AttendeeForms,
+                      path='conference/{websafeConferenceKey}/attendees',
+                      http_method='GET',
+                      name='getConferenceAttendees')
+    @instrumented
+    def getConferenceAttendees(self, request):
+        """Return a page of a conference's attendees (organizer only)."""
+        conf, conf_key = self._getOwnedConference(
+            request.websafeConferenceKey)
+        registrations, next_page = self._fetchPage(
+            attendance.attendeeQuery(conf_key), request)
+        return AttendeeForms(
+            items=[self._copyAttendeeToForm(reg, prof) for reg, prof in
+                   attendance.attendeeRows(registrations)],
+            nextPageToken=next_page)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground',
                       http_method='GET',
                       name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -620,56 +1122,65 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.city == "London")
         q = q.filter(Conference.topics == "Medical Innovations")
         q = q.filter(Conference.month == 6)
+        confs = q.fetch()
+        names = self._getOrganizerNames(confs)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(
+                conf, names.get(conf.organizerUserId)) for conf in confs]
         )
 
 # - - - Session objects - - - - - - - - - - - - - - - - - - -
 
-    def _createSessionObject(self, request):
-        """ Create new sesssion """
+    def _getOwnedConference(self, wsck):
+        """ Return (ConferenceForm, key) of a conference owned by the
+        current user """
         # check login
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException(
-                "Authorization required")
-        # check for required name
-        if not request.name:
-            raise endpoints.BadRequestException(
-                "Session 'name' field required")
+        user, user_id = self._currentUser()
         # check required key
-        wsck = request.websafeConferenceKey
         if not wsck:
             raise endpoints.BadRequestException(
                 "websafeConferenceKey required")
-        # get conference and check if it exists
-        conf = ndb.Key(urlsafe=wsck).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                "No conference by that id")
+        # get conference (cached form) and check if it exists
+        conf = self._getCachedForm(
+            MEMCACHE_CONFERENCE_FORM_KEY, ConferenceForm, wsck,
+            self._loadConferenceForm)
         # check ownership
-        user_id = getUserId(user)
         conf_id = conf.organizerUserId
         if user_id != conf_id:
             raise endpoints.UnauthorizedException(
                 "Unauthorized access")
+        return conf, ndb.Key(urlsafe=wsck)
+
+    def _sessionData(self, request, conf, startDate, endDate):
+        """ Validate a SessionForm against its conference and return
+        the Session property dict """
+        # check for required name
+        if not request.name:
+            raise endpoints.BadRequestException(
+                "Session 'name' field required")
         # copy data
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
         # clear key feild
         del data['websafeKey']
+        data['websafeConferenceKey'] = conf.websafeKey
 
         if data['date']:
-            data['date'] = datetime.strptime(
-                data['date'][:10], "%Y-%m-%d").date()
-            if not conf.startDate <= data['date'] <= conf.endDate:
+            try:
+                data['date'] = datetime.strptime(
+                    data['date'][:10], "%Y-%m-%d").date()
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'Session date must be YYYY-MM-DD: %s' % data['date'])
+            if not startDate <= data['date'] <= endDate:
                 raise endpoints.BadRequestException(
                     'Session date does not match conference date.')
         if data['startTime']:
-            data['startTime'] = datetime.strptime(
-                data['startTime'][:10], "%H%M").time()
-            if not data['startTime']:
+            try:
+                data['startTime'] = datetime.strptime(
+                    data['startTime'][:10], "%H%M").time()
+            except ValueError:
                 raise endpoints.BadRequestException(
                     'Please use military time')
 
@@ -677,62 +1188,107 @@ class ConferenceApi(remote.Service):
             data['typeOfSession'] = str(data['typeOfSession'])
         else:
             data['typeOfSession'] = str(TypeOfSession.Not_Specified)
-
-        # allocate new Session ID using conference parent
-        s_id = Session.allocate_ids(size=1, parent=conf.key)[0]
-        # make Session key from ID
-        s_key = ndb.Key(Session, s_id, parent=conf.key)
-        data['key'] = s_key
-        # store session so that the key can be added to the task
-        newSession = Session(**data)
-        the_key = newSession.key.urlsafe()
-        newSession.put()
+        return data
+
+    def _storeSessions(self, conf_key, datas):
+        """ Write sessions under one conference: one id range, one
+        put_multi, one featured speaker task; returns SessionForms """
+        # allocate new Session IDs using conference parent
+        first, last = Session.allocate_ids(size=len(datas), parent=conf_key)
+        sessions = [Session(key=ndb.Key(Session, s_id, parent=conf_key),
+                            **data)
+                    for s_id, data in zip(range(first, last + 1), datas)]
+        # the put, the featured speaker tasks and the cache writes are
+        # independent, so issue them together and wait once
+        put_futures = ndb.put_multi_async(sessions)
+        sess_keys = [sess.key.urlsafe() for sess in sessions]
         # add featured speaker to task que
-        taskqueue.add(
-            params={'websafeConferenceKey': wsck},
-            url='/tasks/set_featured_speaker'
-            )
-        return self._copySessionToForm(newSession)
+        queue_rpcs = self._queueFeaturedSpeakerAsync(
+            conf_key.urlsafe(), sess_keys)
+        forms = [self._copySessionToForm(sess) for sess in sessions]
+        # prime the cache for the new sessions
+        cache_rpc = memcache.Client().set_multi_async(
+            dict((k, protojson.encode_message(sf))
+                 for k, sf in zip(sess_keys, forms)),
+            time=FORM_CACHE_TTL, key_prefix=MEMCACHE_SESSION_FORM_KEY)
+        for put_future in put_futures:
+            put_future.get_result()
+        # drop the cached schedule only once the sessions are stored, so
+        # a schedule built meanwhile can't be cached without them
+        schedule_rpc = memcache.Client().delete_multi_async(
+            [conf_key.urlsafe()], key_prefix=MEMCACHE_SCHEDULE_KEY)
+        self._waitFeaturedSpeaker(queue_rpcs)
+        cache_rpc.get_result()
+        schedule_rpc.get_result()
+        return forms
+
+    def _createSessionObject(self, request):
+        """ Create new sesssion """
+        conf, conf_key = self._getOwnedConference(
+            request.websafeConferenceKey)
+        data = self._sessionData(request, conf, parseDate(conf.startDate),
+                                 parseDate(conf.endDate))
+        return self._storeSessions(conf_key, [data])[0]
 
     @endpoints.method(SessionForm, SessionForm,
                       path='conference/newsession',
                       http_method='POST',
                       name='createSession')
+    @instrumented
     def createSession(self, request):
         """ create new session """
         return self._createSessionObject(request)
 
+    @endpoints.method(SESS_POST_MULTI, SessionForms,
+                      path='conference/{websafeConferenceKey}/sessions',
+                      http_method='POST',
+                      name='createSessions')
+    @instrumented
+    def createSessions(self, request):
+        """ create many sessions for one conference in one request """
+        if not request.sessions:
+            raise endpoints.BadRequestException("No sessions given")
+        if len(request.sessions) > MAX_SESSIONS_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                "At most %d sessions per request" % MAX_SESSIONS_PER_REQUEST)
+        conf, conf_key = self._getOwnedConference(
+            request.websafeConferenceKey)
+        startDate = parseDate(conf.startDate)
+        endDate = parseDate(conf.endDate)
+        # validate everything before writing anything
+        datas = [self._sessionData(sess, conf, startDate, endDate)
+                 for sess in request.sessions]
+        return SessionForms(sessions=self._storeSessions(conf_key, datas))
+
     def _copySessionToForm(self, sess):
-        sf = SessionForm()
-        for field in sf.all_fields():
-            # convert to strings
-            if hasattr(sess, field.name):
-                # convert date
-                if field.name.endswith('date'):
-                    setattr(sf, field.name,
-                            str(getattr(sess, field.name)))
-                # convert time
-                elif field.name.endswith('startTime'):
-                    setattr(sf, field.name,
-                            str(getattr(sess, field.name)))
-                # convert enum
-                elif field.name.endswith('typeOfSession'):
-                    setattr(sf, field.name,
-                            getattr(TypeOfSession,
-                                    getattr(sess, field.name)))
-                # finish
-                else:
-                    setattr(sf, field.name,
-                            getattr(sess, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, sess.key.urlsafe())
-        sf.check_initialized()
-        return sf
+        """ Copy Session to SessionForm (date, time and enum converted) """
+        return copyToForm(sess, SessionForm)
+
+    @endpoints.method(SESS_GET_SESSION, SessionForm,
+                      path='session/{websafeSessionKey}',
+                      http_method='GET',
+                      name='getSession')
+    @instrumented
+    def getSession(self, request):
+        """ Return a session by websafe key """
+        return self._getCachedForm(
+            MEMCACHE_SESSION_FORM_KEY, SessionForm,
+            request.websafeSessionKey, self._loadSessionForm)
+
+    def _loadSessionForm(self, websafeSessionKey):
+        """ Build the SessionForm served by getSession """
+        sess = ndb.Key(urlsafe=websafeSessionKey).get()
+        # check for session
+        if not sess:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % websafeSessionKey)
+        return self._copySessionToForm(sess)
 
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/session',
                       http_method='GET',
                       name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
         """ Return conference sessions """
         # get query with filter for matching keys
@@ -740,16 +1296,65 @@ class ConferenceApi(remote.Service):
                 Session.websafeConferenceKey == request.websafeConferenceKey)
         # order by start time
         q = q.order(Session.startTime)
-        # retrieve data
-        sessions = q.fetch()
+        # retrieve one page of data
+        sessions, next_page = self._fetchPage(q, request)
         # return a form
         return SessionForms(
-            sessions=[self._copySessionToForm(sess) for sess in sessions])
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            nextPageToken=next_page)
+
+    @endpoints.method(CONF_GET_REQUEST, ScheduleForm,
+                      path='conference/{websafeConferenceKey}/schedule',
+                      http_method='GET',
+                      name='getConferenceSchedule')
+    @instrumented
+    def getConferenceSchedule(self, request):
+        """ Return all conference sessions grouped by day """
+        return self._getCachedForm(
+            MEMCACHE_SCHEDULE_KEY, ScheduleForm,
+            request.websafeConferenceKey, self._loadSchedule)
+
+    def _loadSchedule(self, websafeConferenceKey):
+        """ Build the ScheduleForm served by getConferenceSchedule """
+        return self._loadScheduleAsync(websafeConferenceKey).get_result()
+
+    @ndb.tasklet
+    def _loadScheduleAsync(self, websafeConferenceKey):
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        # sessions are children of the conference: an ancestor query is
+        # strongly consistent and already sorted by day, then time
+        q = Session.query(ancestor=conf_key).order(
+            Session.date, Session.startTime)
+        conf, sessions = yield conf_key.get_async(), q.fetch_async()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s'
+                % websafeConferenceKey)
+        # resolve every speaker name in one batched get
+        spk_keys = sorted(set(k for sess in sessions
+                              for k in sess.speakerKeys))
+        speakers = yield ndb.get_multi_async(
+            [ndb.Key(urlsafe=k) for k in spk_keys])
+        names = dict((k, speaker.name)
+                     for k, speaker in zip(spk_keys, speakers) if speaker)
+        # sessions arrive in date order, so each day is one run
+        days = []
+        for sess in sessions:
+            day = str(sess.date) if sess.date else None
+            if not days or days[-1].date != day:
+                days.append(ScheduleDayForm(date=day))
+            days[-1].sessions.append(ScheduleSessionForm(
+                session=self._copySessionToForm(sess),
+                speakerNames=[names[k] for k in sess.speakerKeys
+                              if k in names]))
+        raise ndb.Return(ScheduleForm(
+            websafeConferenceKey=websafeConferenceKey, days=days))
 
     @endpoints.method(SESS_GET_SPEAKER, SessionForms,
                       path='session/speaker/{websafeSpeakerKey}',
                       http_method='GET',
                       name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
         """ Return sessions by speaker """
         # query and filter by speaker name
@@ -757,16 +1362,18 @@ class ConferenceApi(remote.Service):
             Session.speakerKeys == request.websafeSpeakerKey)
         # ordy by start time
         q = q.order(Session.startTime)
-        # retrieve data
-        sessions = q.fetch()
+        # retrieve one page of data
+        sessions, next_page = self._fetchPage(q, request)
         # return form
         return SessionForms(
-            sessions=[self._copySessionToForm(sess) for sess in sessions])
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            nextPageToken=next_page)
 
     @endpoints.method(SESS_GET_TYPE, SessionForms,
                       path='session/type/{typeOfSession}',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """ Return sessions by type """
         # query and filter by speaker name
@@ -775,18 +1382,113 @@ class ConferenceApi(remote.Service):
             Session.typeOfSession == request.typeOfSession)
         # ordy by start time
         q = q.order(Session.startTime)
-        sessions = q.fetch()
+        sessions, next_page = self._fetchPage(q, request)
         # return form
         return SessionForms(
-            sessions=[self._copySessionToForm(sess) for sess in sessions])
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            nextPageToken=next_page)
+
+    def _formatSessionFilters(self, filters):
+        """Parse, check validity and coerce SessionQueryForm filters."""
+        formatted_filters = []
+        for f in filters:
+            try:
+                prop, parse = SESSION_FIELDS[f.field]
+                op = OPERATORS[f.operator]
+            except KeyError:
+                raise endpoints.BadRequestException(
+                    "Filter contains invalid field or operator.")
+            try:
+                value = parse(f.value)
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException(
+                    "Invalid value for %s: %s" % (f.field, f.value))
+            formatted_filters.append(
+                {"field": prop, "operator": op, "value": value})
+        return formatted_filters
+
+    def _planSessionQuery(self, filters, ancestor=None):
+        """Return (query, residual filters) for the session filters.
+
+        Only the most selective filter goes to the datastore, so every
+        plan is served by a built-in single-property index (plus the
+        ancestor); the remaining filters are applied in memory.
+        '!=' is never pushed down since it would fan out into two
+        queries.
+        """
+        def rank(filtr):
+            equality = filtr["operator"] == "="
+            return (not equality,
+                    SESSION_SELECTIVITY.index(filtr["field"]))
+
+        candidates = [f for f in filters if f["operator"] != "!="]
+        # ancestor + inequality needs a composite index; keep to equality
+        if ancestor:
+            candidates = [f for f in candidates if f["operator"] == "="]
+        q = Session.query(ancestor=ancestor)
+        if not candidates:
+            return q.order(Session.key), filters
+        best = min(candidates, key=rank)
+        # compare through the model property so dates and times are
+        # converted to their stored form
+        prop = Session._properties[best["field"]]
+        q = q.filter(prop._comparison(best["operator"], best["value"]))
+        if best["operator"] != "=":
+            q = q.order(prop)
+        q = q.order(Session.key)
+        return q, [f for f in filters if f is not best]
+
+    def _sessionMatches(self, sess, filters):
+        """Return True if sess passes every in-memory filter."""
+        for filtr in filters:
+            op = ops[filtr["operator"]]
+            value = getattr(sess, filtr["field"])
+            if isinstance(value, list):
+                # repeated property: like the datastore, any value may match
+                if not any(op(v, filtr["value"]) for v in value):
+                    return False
+            elif value is None or not op(value, filtr["value"]):
+                return False
+        return True
+
+    @endpoints.method(SessionQueryForms, SessionForms,
+                      path='querySessions',
+                      http_method='POST',
+                      name='querySessions')
+    @instrumented
+    def querySessions(self, request):
+        """ Query sessions by type, speaker, date, start time and duration """
+        filters = self._formatSessionFilters(request.filters)
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        q, residual = self._planSessionQuery(filters, ancestor)
+        page_size, cursor = self._pageParams(request)
+
+        # stream batches, keeping only matches; stop when the page is
+        # full or MAX_SESSION_SCAN entities have been read
+        sessions = []
+        scanned = 0
+        it = q.iter(start_cursor=cursor, produce_cursors=True,
+                    batch_size=SESSION_SCAN_BATCH)
+        for sess in it:
+            scanned += 1
+            if self._sessionMatches(sess, residual):
+                sessions.append(sess)
+            if len(sessions) >= page_size or scanned >= MAX_SESSION_SCAN:
+                break
+        next_page = None
+        if scanned and it.probably_has_next():
+            next_page = it.cursor_after().urlsafe()
+        return SessionForms(
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            nextPageToken=next_page)
 
 # - - - Speaker objects - - - - - - - - - - - - - - - - - - -
 
     def _createSpeakerObject(self, request):
         """ Creates speaker entity """
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required.')
+        self._currentUser()
         # 'name' is a required field
         if not request.name:
             raise endpoints.BadRequestException("Speaker name required")
@@ -802,98 +1504,83 @@ class ConferenceApi(remote.Service):
 
     def _copySpeakerToForm(self, speaker):
         """ speaker info in form format """
-        # get form
-        sf = SpeakerForm()
-        # fill in feilds
-        for field in sf.all_fields():
-            # generic fields
-            if hasattr(speaker, field.name):
-                setattr(sf, field.name, getattr(speaker, field.name))
-            # special field
-            elif field.name == 'websafeKey':
-                setattr(sf, field.name, speaker.key.urlsafe())
-        # initialize
-        sf.check_initialized()
-        return sf
+        return copyToForm(speaker, SpeakerForm)
 
     @endpoints.method(SpeakerForm, SpeakerForm,
                       path='speaker',
                       http_method='POST', name='createSpeaker')
+    @instrumented
     def createSpeaker(self, request):
         """ Create new speaker object """
         return self._createSpeakerObject(request)
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @endpoints.method(SPK_GET_REQUEST, SpeakerForms,
                       path='speakers',
                       http_method='GET', name='getSpeakers')
+    @instrumented
     def getSpeakers(self, request):
         """ retrieve all speakers by name """
+        options, fields = self._listOptions(
+            request.fields, SpeakerForm, SPEAKER_PROJECTION)
         # query speakers and order by name
-        speakers = Speaker.query().order(Speaker.name)
-        return SpeakerForms(
-            speakers=[self._copySpeakerToForm(speak) for speak in speakers])
+        q = Speaker.query().order(Speaker.name)
+        speakers, next_page = self._fetchPage(q, request, **options)
+        if options.get('keys_only'):
+            forms = [SpeakerForm(websafeKey=key.urlsafe())
+                     for key in speakers]
+        else:
+            forms = [copyToForm(speak, SpeakerForm, fields)
+                     for speak in speakers]
+        return SpeakerForms(speakers=forms, nextPageToken=next_page)
 
     @endpoints.method(SPK_GET_SPEAKER, SpeakerForm,
                       path='getSpeaker',
                       http_method='GET', name='getSpeaker')
+    @instrumented
     def getSpeaker(self, request):
         """ Get speakers by urlsafe key """
+        return self._getCachedForm(
+            MEMCACHE_SPEAKER_FORM_KEY, SpeakerForm,
+            request.websafeSpeakerKey, self._loadSpeakerForm)
+
+    def _loadSpeakerForm(self, websafeSpeakerKey):
+        """ Build the SpeakerForm served by getSpeaker """
         # query speakers by keys
-        speaker = ndb.Key(urlsafe=request.websafeSpeakerKey).get()
+        speaker = ndb.Key(urlsafe=websafeSpeakerKey).get()
         if not speaker:
             raise endpoints.NotFoundException(
                 'No speaker found with key: %s'
-                % request.websafeSpeakerKey)
+                % websafeSpeakerKey)
         # return speaker form
         return self._copySpeakerToForm(speaker)
 
 # - - - Wishlist objects - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _sessionWishList(self, request, to_add=True):
-        # return value flaggs completed or not
-        retval = False
         # get user profile
         prof = self._getProfileFromUser()
-        # get session key
+        # get session key and check session exists (cached form;
+        # raises NotFoundException otherwise)
         sess_Key = request.websafeSessionKey
-        sess = ndb.Key(urlsafe=sess_Key).get()
-
-        # check for session
-        if not sess:
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % sess_Key)
+        self._getCachedForm(MEMCACHE_SESSION_FORM_KEY, SessionForm,
+                            sess_Key, self._loadSessionForm)
 
-        # add or remove session
-        if to_add:
-            # check for pre-existing session
-            if sess_Key in prof.sessionWishlistKeys:
+        # add or remove the session's WishlistEntry (transactional,
+        # touches only that entry)
+        if not attendance.setWishlisted(prof.key, sess_Key, to_add):
+            if to_add:
                 raise ConflictException(
                     "You have already added this session")
-            # add session to dic
-            prof.sessionWishlistKeys.append(sess_Key)
-            # return true
-            retval = True
-        else:
-            # check for pre-existing session
-            if sess_Key in prof.sessionWishlistKeys:
-                # remove session
-                prof.sessionWishlistKeys.remove(sess_Key)
-                # return true
-                retval = True
-            else:
-                raise ConflictException(
-                    "This session is not in your wishlist")
-
-        # save profile changes
-        prof.put()
+            raise ConflictException(
+                "This session is not in your wishlist")
         # return boolean
-        return BooleanMessage(data=retval)
+        return BooleanMessage(data=True)
 
     @endpoints.method(SESS_POST_WISHLIST, BooleanMessage,
                       path='session/{websafeSessionKey}/wishlist/post',
                       http_method='POST',
                       name='addSessionToWishlist')
+    @instrumented
     def addSessionToWishlist(self, request):
         """ Add session to wishlist """
         # pass no value for to_add because it is set to true by default
@@ -903,6 +1590,7 @@ class ConferenceApi(remote.Service):
                       path='session/{websafeSessionKey}/wishlist/delete',
                       http_method='DELETE',
                       name='deleteSessionInWishlist')
+    @instrumented
     def deleteSessionInWishlist(self, request):
         """ Remove session to wishlist """
         # pass false value for to_add because it is set to true by default
@@ -912,13 +1600,16 @@ class ConferenceApi(remote.Service):
                       path='wishlist/get',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Get sessions in user wishlist """
         # get profile info
         prof = self._getProfileFromUser()
         # get wishlist keys and fined sessions
-        wish_keys = [ndb.Key(urlsafe=s) for s in prof.sessionWishlistKeys]
-        sessions = ndb.get_multi(wish_keys)
+        wish_keys = [ndb.Key(urlsafe=entry_key.id()) for entry_key in
+                     attendance.wishlistKeysAsync(prof.key).get_result()]
+        # skip sessions that have been deleted since
+        sessions = [sess for sess in ndb.get_multi(wish_keys) if sess]
         # return sessions in form
         return SessionForms(
             sessions=[self._copySessionToForm(wishes) for wishes in sessions])
@@ -929,6 +1620,7 @@ class ConferenceApi(remote.Service):
                       path='getSpeakerByRating',
                       http_method="GET",
                       name='getSpeakerByRating')
+    @instrumented
     def getSpeakerByRating(self, request):
         """ get speakers based on rating """
         # query speakers
@@ -944,131 +1636,238 @@ class ConferenceApi(remote.Service):
         formatted_query = ndb.query.FilterNode(
             "rating", op, request.value)
         q = q.filter(formatted_query)
+        # key order keeps cursors usable for the '!=' multi-query
+        q = q.order(Speaker.rating, Speaker.key)
+        speakers, next_page = self._fetchPage(q, request)
 
         return SpeakerForms(
-            speakers=[self._copySpeakerToForm(speak) for speak in q])
+            speakers=[self._copySpeakerToForm(speak) for speak in speakers],
+            nextPageToken=next_page)
 
     @endpoints.method(SPEC_GET, ConferenceForms,
                       path='getPercentFullConf',
                       http_method='GET',
                       name='getPercentFullConf')
+    @instrumented
     def getPercentFullConf(self, request):
         """ Get conferences by percent full """
-        # get conferences
-        conf = Conference.query().fetch()
-        # set empty array for conferences
-        conf_array = []
-        percent_array = []
-        # give value a variable
-        value = request.value
         # try to set operator
         try:
-            o = OPERATORS[request.operator]
-            # translate string operator to python
-            # operator using import operator
-            op = ops[o]
+            op = OPERATORS[request.operator]
         except KeyError:
             raise endpoints.BadRequestException(
                 "Filter contains invalid field or operator.")
-        # test percent full
-        for c in conf:
-            sa = c.seatsAvailable
-            ts = c.maxAttendees
-            if ts == 0:
-                percent = 0
-            else:
-                percent = sa/ts*100
-            # add those that pass to new array
-            if op(percent, value):
-                conf_array.append(c)
-                percent_array.append(percent)
-        # sort array by name
-        sorted(conf_array, key=lambda conference: conference.name)
-        # return conferences added to the array
+        # percentFull is stored as a float; compare like with like
+        q = Conference.query(ndb.query.FilterNode(
+            'percentFull', op, float(request.value or 0)))
+        # inequality property sorts first, then name; key order
+        # keeps cursors usable for the '!=' multi-query
+        q = q.order(Conference.percentFull, Conference.name, Conference.key)
+        confs, next_page = self._fetchPage(q, request)
+        names = self._getOrganizerNames(confs)
+        # return conferences on this page
         return ConferenceForms(
             items=[self._copyConferenceToForm(
-                confs, "percent return") for confs in conf_array])
+                conf, names.get(conf.organizerUserId)) for conf in confs],
+            nextPageToken=next_page)
 
     @endpoints.method(SESS_POST_DOUBLE, SessionForms,
                       path='special/Query',
                       http_method='POST',
                       name='getDoubleQuerySession')
+    @instrumented
     def getDoubleQuerySession(self, request):
         """ Return special double inequality query """
-        # empty dic for sessions
-        result = []
-        # query sessions
-        q = Session.query()
         # filter by time
-        formatedTime = datetime.strptime(request.time[:10], "%H%M").time()
-        q = q.filter(Session.startTime < formatedTime)
-        # sort by time
-        q = q.order(Session.startTime)
-        # fetch results
-        sessions = q.fetch()
-        # use python to weed out conference types
-        for sess in sessions:
-            if sess.typeOfSession != request.sess_type:
-                result.append(sess)
+        try:
+            formatedTime = datetime.strptime(
+                request.time[:10], "%H%M").time()
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException('Please use military time')
+        # "type != X" is a second inequality, so ask for every other
+        # type instead: an IN over equality filters that the
+        # (typeOfSession, startTime) index serves directly
+        types = [t for t in TypeOfSession.names() if t != request.sess_type]
+        # optionally limit to one conference (ancestor query)
+        if request.websafeConferenceKey:
+            q = Session.query(
+                ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        else:
+            q = Session.query()
+        q = q.filter(Session.typeOfSession.IN(types),
+                     Session.startTime < formatedTime)
+        # sort by time; key order keeps cursors usable for the IN
+        q = q.order(Session.startTime, Session.key)
+        sessions, next_page = self._fetchPage(q, request)
         # return result of sort
         return SessionForms(
-            sessions=[self._copySessionToForm(sess) for sess in result])
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            nextPageToken=next_page)
 
 # - - - Featured speaker - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _queueFeaturedSpeaker(wsck, websafeSessionKeys):
+        """ Queue new sessions for the featured speaker index.
+
+        The session keys go to a pull queue tagged with the conference;
+        at most one named /tasks/set_featured_speaker push task is added
+        per FEATURED_SPEAKER_DELAY seconds to drain it, so a bulk import
+        costs one index update per conference instead of one per session.
+        """
+        ConferenceApi._waitFeaturedSpeaker(
+            ConferenceApi._queueFeaturedSpeakerAsync(wsck, websafeSessionKeys))
+
+    @staticmethod
+    def _queueFeaturedSpeakerAsync(wsck, websafeSessionKeys):
+        """ Start both task adds of _queueFeaturedSpeaker; returns the
+        RPCs to pass to _waitFeaturedSpeaker """
+        pull_rpc = taskqueue.Queue(FEATURED_SPEAKER_QUEUE).add_async(
+            taskqueue.Task(payload=','.join(websafeSessionKeys),
+                           method='PULL', tag=wsck))
+        push_rpc = scheduleOnceAsync('featured-speaker',
+                                     '/tasks/set_featured_speaker',
+                                     window=FEATURED_SPEAKER_DELAY)
+        return pull_rpc, push_rpc
+
+    @staticmethod
+    def _waitFeaturedSpeaker(rpcs):
+        pull_rpc, push_rpc = rpcs
+        pull_rpc.get_result()
+        # this time bucket's drain task may already be queued
+        waitScheduled(push_rpc)
+
     @staticmethod
     def _cacheSpeaker(request):
-        """ Memcache speaker announcement """
-        # print 'got to cache'
-        # init dic for organizing speaker and sessions
-        spk_dic = {}
-        # init return string
-        featured = ""
-        # init featured speaker
-        featured_speaker = ""
-        # get all sessions with speakers in current conference
-        # use ancestor query for strong consistency
-        wsck = request.get('websafeConferenceKey')
-        sessions = Session.query(
-                ancestor = ndb.Key(urlsafe=wsck))
-        # create dictionary with organized speakers and sessions
-        for sess in sessions:
-            # check for empty speaker key arrays
-            if len(sess.speakerKeys) > 0:
-                for spk_key in sess.speakerKeys:
-                    if spk_key in spk_dic.keys():
-                        spk_dic[spk_key].append(sess)
-                    else:
-                        spk_dic[spk_key] = [sess]
-        # iterate through speakers
-        for spk_key in spk_dic:
-            # if speakers are present in more than one session
-            if len(spk_dic[spk_key]) > 1:
-                # get speaker information
-                # should use spk_array to get name rather than get?
-                speaker = ndb.Key(urlsafe=spk_key).get()
-                # set featured speaker
-                featured_speaker = FEATURED_SPEAKER_TPL % (
-                    speaker.name,
-                    ', '.join(s.name for s in spk_dic[spk_key])
-                    )
-            else:
-                featured_speaker = ""
-            # combine featured speakers if there are more than one
-            featured += featured_speaker + "\n"
+        """ Memcache speaker announcements for every conference with
+        queued sessions, one index update per conference """
+        # tasks queued before the pull queue existed carry their session
+        if request.get('websafeConferenceKey'):
+            ConferenceApi._updateFeaturedSpeaker(
+                request.get('websafeConferenceKey'),
+                [request.get('websafeSessionKey')])
+
+        queue = taskqueue.Queue(FEATURED_SPEAKER_QUEUE)
+        failed = []
+        while True:
+            tasks = queue.lease_tasks(FEATURED_SPEAKER_LEASE,
+                                      FEATURED_SPEAKER_BATCH)
+            if not tasks:
+                break
+            # group the batch by conference
+            batches = collections.defaultdict(list)
+            for task in tasks:
+                batches[task.tag].append(task)
+            done = []
+            for wsck, conf_tasks in batches.items():
+                sess_keys = [k for task in conf_tasks
+                             for k in task.payload.split(',')]
+                try:
+                    ConferenceApi._updateFeaturedSpeaker(wsck, sess_keys)
+                except Exception:
+                    logging.exception(
+                        'Featured speaker update failed for %s', wsck)
+                    failed.extend(conf_tasks)
+                    continue
+                done.extend(conf_tasks)
+            queue.delete_tasks(done)
+            if len(tasks) < FEATURED_SPEAKER_BATCH:
+                break
+        if failed:
+            # the push task is retried well inside FEATURED_SPEAKER_LEASE,
+            # so hand the failed pull tasks back for the retry to lease
+            for task in failed:
+                queue.modify_task_lease(task, 0)
+            raise taskqueue.Error('Featured speaker update failed')
+
+    @staticmethod
+    def _updateFeaturedSpeaker(wsck, websafeSessionKeys):
+        """ Add sessions to the conference's featured speaker index and
+        rewrite the memcache announcement if the featured list changed """
+        index = FeaturedSpeakerIndex.get_by_id(wsck)
+        if index is None:
+            # first run for this conference: count every session once
+            # use ancestor query for strong consistency
+            sessions = Session.query(ancestor=ndb.Key(urlsafe=wsck)).fetch()
+        else:
+            # only fetch sessions that have not been counted yet
+            seen = set(index.sessionKeys)
+            sessions = ndb.get_multi(
+                [ndb.Key(urlsafe=k) for k in set(websafeSessionKeys)
+                 if k and k not in seen])
+        sessions = [sess for sess in sessions if sess]
+        if not sessions:
+            return index.featured if index else ""
+
+        index, featured_keys = ConferenceApi._addToSpeakerIndex(
+            wsck, sessions)
+        # featured list can only change if a new session's speaker now
+        # has more than one session
+        if featured_keys is None:
+            return index.featured
+        # resolve all featured speaker names in one batched get
+        speakers = ndb.get_multi([ndb.Key(urlsafe=k) for k in featured_keys])
+        featured = "\n".join(
+            FEATURED_SPEAKER_TPL % (
+                speaker.name, ', '.join(index.speakerSessions[spk_key]))
+            for spk_key, speaker in zip(featured_keys, speakers) if speaker)
+        if featured != index.featured:
+            ConferenceApi._storeFeatured(wsck, featured)
+            # setting the memcache key allows for conference unique keys
+            memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY + wsck, featured)
+        return featured
 
-        # setting the memcache key allows for conference unique keys
-        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY + wsck, featured)
+    @staticmethod
+    @ndb.transactional()
+    def _addToSpeakerIndex(wsck, sessions):
+        """ Tally sessions per speaker; transactional so concurrent
+        tasks for the same conference don't lose counts. Returns the
+        index and, if a touched speaker is featured, the sorted keys of
+        all featured speakers (else None) """
+        index = (FeaturedSpeakerIndex.get_by_id(wsck) or
+                 FeaturedSpeakerIndex(id=wsck))
+        seen = set(index.sessionKeys)
+        tally = dict(index.speakerSessions or {})
+        touched = set()
+        for sess in sessions:
+            sess_key = sess.key.urlsafe()
+            if sess_key in seen:
+                continue
+            seen.add(sess_key)
+            index.sessionKeys.append(sess_key)
+            for spk_key in sess.speakerKeys:
+                tally.setdefault(spk_key, []).append(sess.name)
+                touched.add(spk_key)
+        index.speakerSessions = tally
+        index.put()
+
+        if not any(len(tally[spk_key]) > 1 for spk_key in touched):
+            return index, None
+        return index, sorted(
+            spk_key for spk_key, names in tally.items() if len(names) > 1)
 
-        return featured_speaker
+    @staticmethod
+    @ndb.transactional()
+    def _storeFeatured(wsck, featured):
+        """ Save the rendered announcement on the index """
+        index = FeaturedSpeakerIndex.get_by_id(wsck)
+        index.featured = featured
+        index.put()
 
     @endpoints.method(FEAT_GET_SPEAKER, StringMessage,
                       path='conference/{websafeConferenceKey}/feature',
                       name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
         """Reaturn Featured Speaker and Sessions from memcache."""
         wsck = request.websafeConferenceKey
         memcache_key = MEMCACHE_FEATURED_SPEAKER_KEY + wsck
-        return StringMessage(data=memcache.get(memcache_key) or "")
+        featured = memcache.get(memcache_key)
+        if featured is None:
+            # evicted; restore from the stored index
+            index = FeaturedSpeakerIndex.get_by_id(wsck)
+            featured = index.featured if index else ""
+            memcache.set(memcache_key, featured)
+        return StringMessage(data=featured)
 
 api = endpoints.api_server([ConferenceApi])  # register API
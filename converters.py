@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Precompiled entity -> ProtoRPC form copy plans. The field mapping for
+each model/form pair is worked out once at import time (dates and times
+become strings, stored enum names become Enum values, websafeKey comes
+from the entity key), so copying a row is a flat loop of getter calls
+instead of all_fields()/hasattr/endswith reflection.
+
+"""
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+from models import Conference, ConferenceForm
+from models import Profile, ProfileForm
+from models import Session, SessionForm
+from models import Speaker, SpeakerForm
+
+_CONVERTERS = {}
+
+
+def _plain(name):
+    def get(entity):
+        return getattr(entity, name)
+    return get
+
+
+def _string(name):
+    def get(entity):
+        return str(getattr(entity, name))
+    return get
+
+
+def _enum(name, enum_cls):
+    def get(entity):
+        return getattr(enum_cls, getattr(entity, name))
+    return get
+
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+
+class FormConverter(object):
+    """Copies one model's entities into one form class."""
+
+    def __init__(self, model_cls, form_cls):
+        self.form_cls = form_cls
+        plan = []
+        for field in form_cls.all_fields():
+            prop = model_cls._properties.get(field.name)
+            if prop is not None:
+                if isinstance(prop, (ndb.DateProperty, ndb.TimeProperty)):
+                    get = _string(field.name)
+                elif isinstance(field, messages.EnumField):
+                    get = _enum(field.name, field.type)
+                else:
+                    get = _plain(field.name)
+            elif field.name == 'websafeKey':
+                get = _websafeKey
+            else:
+                continue
+            plan.append((field.name, get))
+        self.plan = tuple(plan)
+        self.required = any(f.required for f in form_cls.all_fields())
+
+    def __call__(self, entity, fields=None):
+        """Copy entity; with fields, copy only those (sparse form, e.g.
+        from a projection query that loaded only those properties)."""
+        form = self.form_cls()
+        for name, get in self.plan:
+            if fields is None or name in fields:
+                setattr(form, name, get(entity))
+        if self.required:
+            form.check_initialized()
+        return form
+
+
+def register(model_cls, form_cls):
+    """Build and register the converter for model_cls -> form_cls."""
+    converter = _CONVERTERS[model_cls, form_cls] = FormConverter(
+        model_cls, form_cls)
+    return converter
+
+
+def copyToForm(entity, form_cls, fields=None):
+    """Return a new form_cls filled from entity (only fields, if given)."""
+    return _CONVERTERS[type(entity), form_cls](entity, fields)
+
+
+register(Conference, ConferenceForm)
+register(Profile, ProfileForm)
+register(Session, SessionForm)
+register(Speaker, SpeakerForm)
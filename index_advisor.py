@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""index_advisor.py
+
+Works out the Conference composite indexes queryConferences needs.
+
+Every filter plan ConferenceApi._formatFilters/_getQuery can produce is
+enumerated: any set of equality filters over FIELDS plus at most one
+inequality field, ordered by the inequality field, then name (then key).
+The datastore can answer a plan with several equality filters by
+zigzag merge-joining one index per equality property, as long as each
+index ends in the same sort order. So the minimal covering set is one
+(equality property, [inequality property,] name) index per pair, not one
+index per combination. Plans that depend on a merge join are reported.
+
+    APPENGINE_SDK=/path/to/google_appengine python index_advisor.py
+    python index_advisor.py --check index.yaml   # missing/redundant
+
+"""
+
+import argparse
+import itertools
+import os
+import sys
+
+KIND = 'Conference'
+ORDER = ('name',)
+
+
+def enumeratePlans(fields):
+    """Yield (equality fields, inequality field or None) for every plan.
+
+    Equality filters on the same property more than once (e.g. two
+    topics) use the same indexes as one, so sets are enough here.
+    """
+    for inequality in (None,) + tuple(fields):
+        for n in range(len(fields) + 1):
+            for equality in itertools.combinations(fields, n):
+                yield frozenset(equality), inequality
+
+
+def planIndexes(equality, inequality):
+    """Return the indexes a plan uses, as property tuples.
+
+    Returns an empty list when the built-in single property indexes
+    are enough (no filters, ordered by name only).
+    """
+    sort = ((inequality,) if inequality else ()) + ORDER
+    merged = sorted(equality - set([inequality]))
+    if not merged:
+        return [sort] if inequality else []
+    return [(field,) + sort for field in merged]
+
+
+def fullComposite(equality, inequality):
+    """Return the single exact composite index for a plan (or None)."""
+    merged = tuple(sorted(equality - set([inequality])))
+    sort = ((inequality,) if inequality else ()) + ORDER
+    if not merged and not inequality:
+        return None
+    return merged + sort
+
+
+def advise(fields):
+    """Return (minimal index set, plans needing a merge join, number of
+    plans, number of exact composites the plans would otherwise need)."""
+    indexes = set()
+    merge_joins = []
+    composites = set()
+    plans = 0
+    for equality, inequality in enumeratePlans(fields):
+        plans += 1
+        used = planIndexes(equality, inequality)
+        indexes.update(used)
+        if len(used) > 1:
+            merge_joins.append((equality, inequality))
+        exact = fullComposite(equality, inequality)
+        if exact:
+            composites.add(exact)
+    return sorted(indexes), merge_joins, plans, len(composites)
+
+
+def toYaml(indexes):
+    lines = []
+    for props in indexes:
+        lines.append('- kind: %s' % KIND)
+        lines.append('  properties:')
+        lines.extend('  - name: %s' % p for p in props)
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def readIndexes(path):
+    """Return the Conference indexes of an index.yaml as tuples."""
+    import yaml
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    return set(tuple(p['name'] for p in index.get('properties', []))
+               for index in config.get('indexes') or []
+               if index['kind'] == KIND and not index.get('ancestor'))
+
+
+def describe(equality, inequality):
+    parts = ['%s =' % f for f in sorted(equality)]
+    if inequality:
+        parts.append('%s <>' % inequality)
+    return ', '.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', metavar='INDEX_YAML',
+                        help='report missing and redundant indexes')
+    args = parser.parse_args()
+
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk and sdk not in sys.path:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    from conference import FIELDS
+
+    fields = sorted(FIELDS.values())
+    indexes, merge_joins, plans, composites = advise(fields)
+    print '# %d filter plans; %d exact composites vs %d with merge joins' % (
+        plans, composites, len(indexes))
+    print toYaml(indexes)
+    print '# plans served by zigzag merge join:'
+    for equality, inequality in merge_joins:
+        print '#   %s' % describe(equality, inequality)
+
+    if args.check:
+        existing = readIndexes(args.check)
+        wanted = set(indexes)
+        for props in sorted(wanted - existing):
+            print 'MISSING   %s' % ', '.join(props)
+        for props in sorted(existing - wanted):
+            # indexes over other properties belong to other queries
+            if set(props[:-1]) <= set(fields):
+                print 'REDUNDANT %s' % ', '.join(props)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Per-endpoint latency and RPC accounting. Wrap an endpoint method or task
+handler method with @instrumented and every call records its wall time,
+the RPCs it issued per service (datastore_v3, memcache, taskqueue,
+urlfetch, ...), the entities it read and wrote and the size of its
+response. Each call is logged as one JSON line and folded into
+in-process histograms, served by /admin/instrumentation (main.py).
+
+RPCs are counted by apiproxy pre/post call hooks, so nothing in the
+app has to report them. Instrumentation is on in the dev server and the
+testbed; set INSTRUMENTATION=1 (e.g. in app.yaml env_variables) to turn
+it on elsewhere, or 0 to turn it off. Histograms are per instance.
+
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from protorpc import messages
+from protorpc import protojson
+
+# upper bounds (ms) of the latency histogram buckets; the last is open
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+HOOK_NAME = 'instrumentation'
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+_hooked = [None]
+
+
+def enabled():
+    """Return True if calls should be instrumented."""
+    flag = os.environ.get('INSTRUMENTATION')
+    if flag is not None:
+        return flag.lower() not in ('', '0', 'false', 'off')
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+class CallRecord(object):
+    """Counters for one instrumented call."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rpcs = {}
+        self.read = 0
+        self.written = 0
+        self.bytes = 0
+        self.ms = 0.0
+        self.error = None
+
+    def asDict(self):
+        return {'name': self.name, 'ms': round(self.ms, 3),
+                'rpcs': self.rpcs, 'read': self.read,
+                'written': self.written, 'bytes': self.bytes,
+                'error': self.error}
+
+
+def _records():
+    stack = getattr(_local, 'records', None)
+    if stack is None:
+        stack = _local.records = []
+    return stack
+
+
+def _entityCounts(call, request, response):
+    """Return (read, written) entity counts of a datastore_v3 call."""
+    if call == 'Get':
+        return sum(1 for e in response.entity_list() if e.has_entity()), 0
+    if call in ('RunQuery', 'Next'):
+        return response.result_size(), 0
+    if call == 'Put':
+        return 0, request.entity_size()
+    if call == 'Delete':
+        return 0, request.key_size()
+    return 0, 0
+
+
+def _preCall(service, call, request, response):
+    for record in _records():
+        record.rpcs[service] = record.rpcs.get(service, 0) + 1
+
+
+def _postCall(service, call, request, response, rpc, error):
+    records = _records()
+    if not records or service != 'datastore_v3' or error:
+        return
+    try:
+        read, written = _entityCounts(call, request, response)
+    except AttributeError:
+        return
+    for record in records:
+        record.read += read
+        record.written += written
+
+
+def install():
+    """Add the RPC hooks to the current apiproxy (once per apiproxy;
+    testbed activation replaces it)."""
+    proxy = apiproxy_stub_map.apiproxy
+    if _hooked[0] is proxy:
+        return
+    proxy.GetPreCallHooks().Append(HOOK_NAME, _preCall)
+    proxy.GetPostCallHooks().Append(HOOK_NAME, _postCall)
+    _hooked[0] = proxy
+
+
+class Histogram(object):
+    """Aggregated records of one endpoint or handler."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.ms_total = 0.0
+        self.ms_max = 0.0
+        self.rpcs = {}
+        self.read = 0
+        self.written = 0
+        self.bytes_total = 0
+        self.bytes_max = 0
+
+    def add(self, record):
+        self.count += 1
+        if record.error:
+            self.errors += 1
+        i = 0
+        while i < len(LATENCY_BUCKETS) and record.ms > LATENCY_BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.ms_total += record.ms
+        self.ms_max = max(self.ms_max, record.ms)
+        for service, n in record.rpcs.items():
+            self.rpcs[service] = self.rpcs.get(service, 0) + n
+        self.read += record.read
+        self.written += record.written
+        self.bytes_total += record.bytes
+        self.bytes_max = max(self.bytes_max, record.bytes)
+
+    def percentile(self, p):
+        """Upper bound (ms) of the bucket holding the p-th percentile."""
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.ms_max
+
+    def asDict(self):
+        count = self.count or 1
+        return {
+            'count': self.count, 'errors': self.errors,
+            'ms': {'mean': round(self.ms_total / count, 3),
+                   'p50': self.percentile(50), 'p90': self.percentile(90),
+                   'p99': self.percentile(99),
+                   'max': round(self.ms_max, 3)},
+            'buckets': dict(('le_%s' % bound, n) for bound, n in zip(
+                LATENCY_BUCKETS + ('inf',), self.buckets)),
+            'rpcs_per_call': dict((service, round(n / float(count), 2))
+                                  for service, n in self.rpcs.items()),
+            'entities_per_call': {'read': round(self.read / float(count), 2),
+                                  'written': round(self.written /
+                                                   float(count), 2)},
+            'bytes': {'mean': self.bytes_total // count,
+                      'max': self.bytes_max},
+        }
+
+
+def _responseSize(result, args):
+    """Bytes in the response: the encoded message for endpoints, the
+    body for webapp2 handlers."""
+    if isinstance(result, messages.Message):
+        return len(protojson.encode_message(result))
+    response = getattr(args[0], 'response', None) if args else None
+    if response is not None:
+        return response.content_length or len(response.body)
+    return 0
+
+
+def _record(record):
+    with _lock:
+        histogram = _stats.get(record.name)
+        if histogram is None:
+            histogram = _stats[record.name] = Histogram()
+        histogram.add(record)
+    logging.info('instrumentation %s',
+                 json.dumps(record.asDict(), sort_keys=True))
+
+
+@contextlib.contextmanager
+def recording(name):
+    """Count the RPCs and entities of the enclosed block into a
+    CallRecord (yielded); the record is not logged or aggregated."""
+    install()
+    record = CallRecord(name)
+    records = _records()
+    records.append(record)
+    start = time.time()
+    try:
+        yield record
+    except Exception as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.ms = (time.time() - start) * 1000
+        records.remove(record)
+
+
+def instrumented(fn):
+    """Decorator recording each call of a (service or handler) method
+    under '<Class>.<method>'."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return fn(*args, **kwargs)
+        owner = type(args[0]).__name__ if args else None
+        name = '%s.%s' % (owner, fn.__name__) if owner else fn.__name__
+        try:
+            with recording(name) as record:
+                result = fn(*args, **kwargs)
+        finally:
+            if record.error:
+                _record(record)
+        record.bytes = _responseSize(result, args)
+        _record(record)
+        return result
+    return wrapper
+
+
+def snapshot():
+    """Return {name: histogram dict} for everything recorded so far."""
+    with _lock:
+        return dict((name, histogram.asDict())
+                    for name, histogram in _stats.items())
+
+
+def reset():
+    with _lock:
+        _stats.clear()
@@ -12,12 +12,23 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import csv
+import json
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from instrumentation import instrumented
+import instrumentation
+from utils import getUserId
+import attendance
+import seats
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
+    @instrumented
     def get(self):
         """Set Announcement in Memcache."""
         ConferenceApi._cacheAnnouncement()
@@ -25,6 +36,7 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -37,7 +49,97 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+class BackfillPercentFullHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Store percentFull on existing Conferences, one batch per task."""
+        cursor = ConferenceApi._backfillPercentFull(self.request.get('cursor'))
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                          url='/tasks/backfill_percent_full')
+        self.response.set_status(204)
+
+    @instrumented
+    def get(self):
+        """Start the backfill (admin only, see app.yaml)."""
+        taskqueue.add(url='/tasks/backfill_percent_full')
+        self.response.set_status(202)
+
+class SyncSeatsHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Roll sharded seat counts up onto the Conference."""
+        seats.syncSeats(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+        self.response.set_status(204)
+
+class MigrateAttendanceHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Move Profile attendance lists into child entities, one batch
+        per task."""
+        cursor = attendance.migrateBatch(self.request.get('cursor'))
+        if cursor:
+            taskqueue.add(params={'cursor': cursor},
+                          url='/tasks/migrate_attendance')
+        self.response.set_status(204)
+
+    @instrumented
+    def get(self):
+        """Start the migration (admin only, see app.yaml)."""
+        taskqueue.add(url='/tasks/migrate_attendance')
+        self.response.set_status(202)
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Give freed seats to the conference's waitlist."""
+        ConferenceApi._promoteWaitlist(
+            self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+class AttendeesCsvHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self, wsck):
+        """Write a conference's attendees as CSV for check-in (organizer
+        only); one batch of registrations is held at a time."""
+        user = users.get_current_user()
+        if not user:
+            self.abort(401)
+        try:
+            conf = ndb.Key(urlsafe=wsck).get()
+        except Exception:
+            # malformed websafe key
+            conf = None
+        if not conf:
+            self.abort(404)
+        if getUserId(user) != conf.organizerUserId:
+            self.abort(403)
+
+        self.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename="attendees.csv"')
+        writer = csv.writer(self.response.out)
+        writer.writerow(['displayName', 'mainEmail', 'registered'])
+        api = ConferenceApi()
+        for reg, prof in attendance.iterAttendees(conf.key):
+            form = api._copyAttendeeToForm(reg, prof)
+            writer.writerow([(value or '').encode('utf-8') for value in
+                             (form.displayName, form.mainEmail,
+                              form.registered)])
+
+class InstrumentationHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return this instance's endpoint histograms as JSON (admin
+        only, see app.yaml); ?reset=1 clears them afterwards."""
+        stats = instrumentation.snapshot()
+        if self.request.get('reset'):
+            instrumentation.reset()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
+
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Set Featured Speaker"""
         print "got to main"
@@ -49,4 +151,10 @@ app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
+    ('/tasks/backfill_percent_full', BackfillPercentFullHandler),
+    ('/tasks/sync_seats', SyncSeatsHandler),
+    ('/tasks/migrate_attendance', MigrateAttendanceHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/conference/([^/]+)/attendees\.csv', AttendeesCsvHandler),
+    ('/admin/instrumentation', InstrumentationHandler),
 ], debug=True)
@@ -21,15 +21,28 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
-# added wishlist array 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='Not_Specified')
+    # legacy lists, moved into Registration/WishlistEntry children on
+    # first use (see attendance.py)
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionWishlistKeys = ndb.StringProperty(repeated=True)
 
+class Registration(ndb.Model):
+    """Registration -- an attendee's seat at a Conference; child of
+    the attendee's Profile, keyed by websafeConferenceKey"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- a Session on an attendee's wishlist; child of
+    the attendee's Profile, keyed by websafeSessionKey"""
+    session = ndb.KeyProperty(kind='Session', required=True)
+    conference = ndb.KeyProperty(kind='Conference')
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -44,6 +57,27 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
     sessionWishlistKeys = messages.StringField(5, repeated=True)
 
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat at a full Conference;
+    child of the user's Profile, keyed by websafeConferenceKey"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+    queued = ndb.DateTimeProperty(auto_now_add=True)
+
+class WaitlistForm(messages.Message):
+    """WaitlistForm -- place on a Conference waitlist (0: not waiting)"""
+    position = messages.IntegerField(1, variant=messages.Variant.INT32)
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- one registered attendee of a Conference"""
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+    registered = messages.StringField(3)
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- one page of a Conference's attendees"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -52,6 +86,12 @@ class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
+def computePercentFull(seatsAvailable, maxAttendees):
+    """Return percentage of seats taken as a float (0.0 when uncapped)."""
+    if not maxAttendees:
+        return 0.0
+    return (maxAttendees - (seatsAvailable or 0)) * 100.0 / maxAttendees
+
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
@@ -64,6 +104,18 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # denormalized fill ratio, recomputed on every put() so that
+    # getPercentFullConf can run as an indexed query
+    percentFull     = ndb.ComputedProperty(
+        lambda self: computePercentFull(self.seatsAvailable, self.maxAttendees))
+    # number of SeatShard counters holding the seats (see seats.py)
+    seatShards      = ndb.IntegerProperty(indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's seats, keyed by
+    '<websafeConferenceKey>:<n>' in its own entity group"""
+    capacity        = ndb.IntegerProperty(default=0, indexed=False)
+    taken           = ndb.IntegerProperty(default=0, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -79,10 +131,12 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    percentFull     = messages.FloatField(13)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -111,6 +165,9 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
 
 # - - -Final project addons - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -145,6 +202,24 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """ Session multiple query form """
     sessions = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+# a conference agenda grouped by day, see getConferenceSchedule
+class ScheduleSessionForm(messages.Message):
+    """ One session of a schedule with its speakers' names """
+    session         = messages.MessageField(SessionForm, 1)
+    speakerNames    = messages.StringField(2, repeated=True)
+
+class ScheduleDayForm(messages.Message):
+    """ The sessions of one day, in start time order """
+    date            = messages.StringField(1)
+    sessions        = messages.MessageField(ScheduleSessionForm, 2,
+                                            repeated=True)
+
+class ScheduleForm(messages.Message):
+    """ A conference's sessions grouped by day """
+    websafeConferenceKey = messages.StringField(1)
+    days            = messages.MessageField(ScheduleDayForm, 2, repeated=True)
 
 # enum for session types
 class TypeOfSession(messages.Enum):
@@ -155,6 +230,20 @@ class TypeOfSession(messages.Enum):
     Workshop = 4
     Demonstration = 5
 
+# conferences in the nearly sold out announcement, kept current from
+# seat changes so the announcement is only rebuilt when this set changes
+class AnnouncementIndex(ndb.Model):
+    """ Nearly sold out conferences, websafeConferenceKey -> name """
+    conferences     = ndb.JsonProperty()
+
+# running speaker -> session tally per conference, keyed by
+# websafeConferenceKey, so featured speakers are updated incrementally
+class FeaturedSpeakerIndex(ndb.Model):
+    """ Featured speaker index for one conference """
+    sessionKeys     = ndb.StringProperty(repeated=True, indexed=False)
+    speakerSessions = ndb.JsonProperty()
+    featured        = ndb.TextProperty(default='')
+
 # define entity class for speakers
 class Speaker(ndb.Model):
     """ Speaker Entity Object """
@@ -176,3 +265,18 @@ class SpeakerForm(messages.Message):
 class SpeakerForms(messages.Message):
     """ Speaker multiple query form """
     speakers = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+# general session query, see querySessions
+class SessionQueryForm(messages.Message):
+    """ Session query inbound filter """
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class SessionQueryForms(messages.Message):
+    """ Session query inbound form message """
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    websafeConferenceKey = messages.StringField(2)
+    pageSize = messages.IntegerField(3, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(4)
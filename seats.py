@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counter for Conference registration. A Conference's seats
+are split over NUM_SEAT_SHARDS SeatShard entities, each in its own entity
+group, so concurrent registrations commit against different shards
+instead of all rewriting the Conference. The live total is the sum over
+the shards (memcached); Conference.seatsAvailable is a denormalized copy
+rolled up by the /tasks/sync_seats task for queries and announcements.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SeatShard
+from utils import bumpConferenceGeneration
+from utils import scheduleOnce
+
+NUM_SEAT_SHARDS = 10
+MEMCACHE_SEATS_KEY = "SEATS_AVAILABLE_"
+SEATS_CACHE_TTL = 60
+SYNC_SEATS_DELAY = 10
+
+
+def splitSeats(total, num_shards):
+    """Return num_shards counts that sum to total, spread evenly."""
+    base, extra = divmod(total, num_shards)
+    return [base + (1 if i < extra else 0) for i in range(num_shards)]
+
+
+def shardKeys(conf):
+    """Return the SeatShard keys of a sharded Conference."""
+    wsck = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+            for i in range(conf.seatShards or 0)]
+
+
+def newShards(conf):
+    """Shard conf's seats; return the (unsaved) SeatShard entities.
+
+    Capacity follows maxAttendees and the seats already taken are carried
+    over from seatsAvailable, so this also converts older Conferences.
+    """
+    capacity = max(conf.maxAttendees or 0, conf.seatsAvailable or 0)
+    taken = capacity - (conf.seatsAvailable or 0)
+    conf.seatShards = NUM_SEAT_SHARDS
+    return [SeatShard(key=key, capacity=c, taken=t)
+            for key, c, t in zip(shardKeys(conf),
+                                 splitSeats(capacity, NUM_SEAT_SHARDS),
+                                 splitSeats(taken, NUM_SEAT_SHARDS))]
+
+
+@ndb.transactional(xg=True)
+def _shardConference(conf_key):
+    conf = conf_key.get()
+    if not conf.seatShards:
+        ndb.put_multi([conf] + newShards(conf))
+    return conf
+
+
+def ensureShards(conf):
+    """Return conf, first sharding its seats if it predates SeatShard."""
+    if conf.seatShards:
+        return conf
+    return _shardConference(conf.key)
+
+
+def candidateShards(conf, taking=True):
+    """Return keys of shards that can give up (taking=True) or take
+    back a seat, in random order to spread concurrent registrations.
+    """
+    shards = [s for s in ndb.get_multi(shardKeys(conf)) if s]
+    if taking:
+        shards = [s for s in shards if s.taken < s.capacity]
+    else:
+        shards = [s for s in shards if s.taken > 0]
+    random.shuffle(shards)
+    return [s.key for s in shards]
+
+
+def takeSeat(shard_key):
+    """Take one seat from a shard; call inside a transaction.
+
+    Re-checks the shard so a seat is never handed out twice; returns
+    False when the shard has filled up since it was picked.
+    """
+    shard = shard_key.get()
+    if not shard or shard.taken >= shard.capacity:
+        return False
+    shard.taken += 1
+    shard.put()
+    return True
+
+
+def releaseSeat(shard_key):
+    """Give one seat back to a shard; call inside a transaction."""
+    shard = shard_key.get()
+    if not shard or shard.taken <= 0:
+        return False
+    shard.taken -= 1
+    shard.put()
+    return True
+
+
+def resize(conf, maxAttendees):
+    """Change conf's capacity to maxAttendees; call inside an xg
+    transaction that also puts conf, then forgetSeats() once it has
+    committed. Seats already taken are kept, so shrinking below the
+    attendee count only removes the free seats.
+    """
+    if not conf.seatShards:
+        conf.seatsAvailable = max(
+            0, (conf.seatsAvailable or 0) +
+            maxAttendees - (conf.maxAttendees or 0))
+        return
+    shards = ndb.get_multi(shardKeys(conf))
+    delta = maxAttendees - sum(s.capacity for s in shards)
+    if delta == 0:
+        return
+    if delta > 0:
+        for shard, extra in zip(shards, splitSeats(delta, len(shards))):
+            shard.capacity += extra
+    else:
+        for shard in shards:
+            cut = min(shard.capacity - shard.taken, -delta)
+            shard.capacity -= cut
+            delta += cut
+    ndb.put_multi(shards)
+    conf.seatsAvailable = sum(s.capacity - s.taken for s in shards)
+
+
+def forgetSeats(conf_key):
+    """Drop the cached seat total after a resize has committed."""
+    memcache.delete(MEMCACHE_SEATS_KEY + conf_key.urlsafe())
+
+
+def seatsAvailable(conf):
+    """Return the live number of free seats for conf."""
+    if not conf.seatShards:
+        return conf.seatsAvailable
+    memcache_key = MEMCACHE_SEATS_KEY + conf.key.urlsafe()
+    total = memcache.get(memcache_key)
+    if total is None:
+        total = sum(s.capacity - s.taken
+                    for s in ndb.get_multi(shardKeys(conf)) if s)
+        memcache.add(memcache_key, total, time=SEATS_CACHE_TTL)
+    return total
+
+
+def seatsChanged(conf_key, delta):
+    """Record a committed seat change: adjust the cached total and
+    schedule the roll-up onto Conference.seatsAvailable. Returns the
+    new cached total, or None if it was not cached.
+    """
+    memcache_key = MEMCACHE_SEATS_KEY + conf_key.urlsafe()
+    if delta < 0:
+        total = memcache.decr(memcache_key, -delta)
+    else:
+        total = memcache.incr(memcache_key, delta)
+    scheduleSync(conf_key)
+    return total
+
+
+def scheduleSync(conf_key):
+    """Enqueue at most one /tasks/sync_seats per conference every
+    SYNC_SEATS_DELAY seconds; the task runs after its time bucket closes,
+    so it sees every change made in that bucket.
+    """
+    wsck = conf_key.urlsafe()
+    scheduleOnce('seats-%s' % wsck, '/tasks/sync_seats',
+                 {'websafeConferenceKey': wsck}, SYNC_SEATS_DELAY)
+
+
+def syncSeats(conf_key):
+    """Copy the shard total onto Conference.seatsAvailable (and so
+    percentFull); return the conference, or None if it is gone.
+    """
+    conf = conf_key.get()
+    if not conf or not conf.seatShards:
+        return conf
+    total = sum(s.capacity - s.taken
+                for s in ndb.get_multi(shardKeys(conf)) if s)
+    memcache.set(MEMCACHE_SEATS_KEY + conf_key.urlsafe(), total,
+                 time=SEATS_CACHE_TTL)
+    stored = conf.seatsAvailable
+    conf = _storeSeats(conf_key, total)
+    if stored != total:
+        # queries see the rolled-up count (and percentFull)
+        bumpConferenceGeneration()
+    return conf
+
+
+@ndb.transactional()
+def _storeSeats(conf_key, total):
+    conf = conf_key.get()
+    if conf.seatsAvailable != total:
+        conf.seatsAvailable = total
+        conf.put()
+    return conf
@@ -552,6 +552,8 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     $scope.isUserAttending = false;
 
+    $scope.isUserWaiting = false;
+
     /**
      * Initializes the conference detail page.
      * Invokes the conference.getConference method and sets the returned conference in the $scope.
@@ -596,6 +598,31 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                             $scope.isUserAttending = true;
                         }
                     }
+                    if (!$scope.isUserAttending) {
+                        $scope.getWaitlistPosition();
+                    }
+                }
+            });
+        });
+    };
+
+    /**
+     * Invokes the conference.getWaitlistPosition method and shows the user's place in line.
+     */
+    $scope.getWaitlistPosition = function () {
+        gapi.client.conference.getWaitlistPosition({
+            websafeConferenceKey: $routeParams.websafeConferenceKey
+        }).execute(function (resp) {
+            $scope.$apply(function () {
+                if (resp.error) {
+                    // Failed to get the waitlist position.
+                    $log.error('Failed to get the waitlist position : ' + (resp.error.message || ''));
+                } else if (resp.result.position > 0) {
+                    // The user is waiting for a seat.
+                    $scope.alertStatus = 'info';
+                    $scope.messages = 'You are on the waitlist for this conference, position ' +
+                        resp.result.position;
+                    $scope.isUserWaiting = true;
                 }
             });
         });
@@ -631,8 +658,11 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                         $scope.isUserAttending = true;
                         $scope.conference.seatsAvailable = $scope.conference.seatsAvailable - 1;
                     } else {
-                        $scope.messages = 'Failed to register for the conference';
-                        $scope.alertStatus = 'warning';
+                        // The conference is full: the user was put on the waitlist.
+                        $scope.messages = 'The conference is full; you are on the waitlist';
+                        $scope.alertStatus = 'info';
+                        $scope.isUserWaiting = true;
+                        $scope.getWaitlistPosition();
                     }
                 }
             });
@@ -660,7 +690,13 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                         return;
                     }
                 } else {
-                    if (resp.result) {
+                    if (resp.result && $scope.isUserWaiting) {
+                        // Left the waitlist; no seat was held.
+                        $scope.messages = 'Left the waitlist';
+                        $scope.alertStatus = 'success';
+                        $scope.isUserWaiting = false;
+                        $log.info($scope.messages);
+                    } else if (resp.result) {
                         // Unregister succeeded.
                         $scope.messages = 'Unregistered from the conference';
                         $scope.alertStatus = 'success';
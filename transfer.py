@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""transfer.py
+
+Bulk export/import of Conferences, Sessions and Speakers as
+newline-delimited JSON, for migrating and mirroring data between
+environments.
+
+Every line is one entity: {"kind": ..., "key": [[kind, id], ...],
+"properties": {...}}. Keys are written as (kind, id) paths and the
+websafe key strings stored on Session are rewritten as paths too, so a
+dump can be loaded into a different application. Both directions work
+in chunks (one fetch_page / put_multi per chunk) and record a checkpoint
+file after every chunk so an interrupted run can be resumed.
+
+Imports write entities directly and do not go through createConference,
+so no confirmation emails are sent unless notify=True.
+
+The command line runs on testbed stubs, so nothing it queued would ever
+run and its memcache is not the app's. It imports with inline=True:
+featured speaker indexes are updated in place, no tasks are queued and
+no caches are touched. A running app's cached query results and
+schedules expire within QUERY_CACHE_TTL / FORM_CACHE_TTL
+(conference.py); its featured speakers are re-read from the updated
+indexes once its memcache is flushed.
+
+    APPENGINE_SDK=/path/to/google_appengine python transfer.py \\
+        export dump.ndjson --datastore /path/to/datastore.db
+    python transfer.py import dump.ndjson --checkpoint import.ckpt ...
+
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+KINDS = ('Speaker', 'Conference', 'Session')
+BATCH_SIZE = 500
+
+# string properties holding websafe keys, rewritten as key paths
+KEY_STRING_PROPERTIES = {
+    'Session': ('speakerKeys', 'websafeConferenceKey'),
+}
+
+
+def _readCheckpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _writeCheckpoint(path, state):
+    if not path:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
+
+
+def _keyPath(key):
+    return [list(pair) for pair in key.pairs()]
+
+
+def _keyFromPath(path):
+    from google.appengine.ext import ndb
+    return ndb.Key(pairs=[tuple(pair) for pair in path])
+
+
+def _toJson(entity):
+    """Return the NDJSON record for entity."""
+    from google.appengine.ext import ndb
+    kind = entity._get_kind()
+    refs = KEY_STRING_PROPERTIES.get(kind, ())
+    props = {}
+    for name, prop in entity._properties.items():
+        if isinstance(prop, ndb.ComputedProperty):
+            continue
+        value = getattr(entity, name)
+        if name in refs:
+            if prop._repeated:
+                value = [_keyPath(ndb.Key(urlsafe=v)) for v in value]
+            elif value:
+                value = _keyPath(ndb.Key(urlsafe=value))
+        elif hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        props[name] = value
+    return {'kind': kind, 'key': _keyPath(entity.key), 'properties': props}
+
+
+def _fromJson(record):
+    """Return the (unsaved) entity for an NDJSON record."""
+    from google.appengine.ext import ndb
+    model_cls = ndb.Model._lookup_model(record['kind'])
+    refs = KEY_STRING_PROPERTIES.get(record['kind'], ())
+    values = {}
+    for name, value in record['properties'].items():
+        prop = model_cls._properties.get(name)
+        if prop is None or value is None:
+            continue
+        if name in refs:
+            if prop._repeated:
+                value = [_keyFromPath(v).urlsafe() for v in value]
+            else:
+                value = _keyFromPath(value).urlsafe()
+        elif isinstance(prop, ndb.DateProperty):
+            value = datetime.strptime(value[:10], '%Y-%m-%d').date()
+        elif isinstance(prop, ndb.TimeProperty):
+            value = datetime.strptime(value[:8], '%H:%M:%S').time()
+        values[name] = value
+    return model_cls(key=_keyFromPath(record['key']), **values)
+
+
+def exportEntities(out, kinds=KINDS, batch_size=BATCH_SIZE,
+                   checkpoint=None):
+    """Write kinds to the file object out, one chunk per fetch_page.
+
+    With a checkpoint file an interrupted export picks up after the last
+    completed chunk (out should then be opened for append). Returns the
+    number of entities written by this run.
+    """
+    from google.appengine.datastore.datastore_query import Cursor
+    from google.appengine.ext import ndb
+    import models  # registers the model classes
+
+    state = _readCheckpoint(checkpoint)
+    written = 0
+    for kind in kinds:
+        if kind in state.get('done', []):
+            continue
+        model_cls = ndb.Model._lookup_model(kind)
+        cursor = None
+        if state.get('kind') == kind and state.get('cursor'):
+            cursor = Cursor(urlsafe=state['cursor'])
+        more = True
+        while more:
+            entities, cursor, more = model_cls.query().fetch_page(
+                batch_size, start_cursor=cursor)
+            for entity in entities:
+                out.write(json.dumps(_toJson(entity)) + '\n')
+            out.flush()
+            written += len(entities)
+            state['kind'] = kind
+            state['cursor'] = cursor.urlsafe() if more and cursor else None
+            _writeCheckpoint(checkpoint, state)
+        state.setdefault('done', []).append(kind)
+        state['kind'] = state['cursor'] = None
+        _writeCheckpoint(checkpoint, state)
+    return written
+
+
+def _reserveIds(entities):
+    """Reserve the imported numeric ids so allocate_ids never hands
+    them out again: one allocate_ids(max=...) per kind and parent."""
+    top = {}
+    for entity in entities:
+        key = entity.key
+        if isinstance(key.id(), (int, long)):
+            group = (entity.__class__, key.parent())
+            top[group] = max(top.get(group, 0), key.id())
+    for (model_cls, parent), max_id in top.items():
+        model_cls.allocate_ids(max=max_id, parent=parent)
+
+
+def _importChunk(entities, notify, inline=False):
+    from google.appengine.api import taskqueue
+    from google.appengine.ext import ndb
+    import seats
+    from models import Conference, Session
+
+    _reserveIds(entities)
+    shards = []
+    for entity in entities:
+        if isinstance(entity, Conference):
+            if entity.seatsAvailable is None:
+                entity.seatsAvailable = entity.maxAttendees or 0
+            entity.seatShards = None
+            if entity.maxAttendees > 0 or entity.seatsAvailable > 0:
+                shards.extend(seats.newShards(entity))
+    ndb.put_multi(entities + shards)
+    if not inline and any(isinstance(entity, Conference)
+                          for entity in entities):
+        from utils import bumpConferenceGeneration
+        bumpConferenceGeneration()
+
+    # one featured speaker update per conference touched
+    sessions = {}
+    for entity in entities:
+        if isinstance(entity, Session):
+            sessions.setdefault(entity.key.parent().urlsafe(), []).append(
+                entity.key.urlsafe())
+    if sessions and inline:
+        from conference import ConferenceApi
+        for wsck, sess_keys in sessions.items():
+            ConferenceApi._updateFeaturedSpeaker(wsck, sess_keys)
+    elif sessions:
+        from google.appengine.api import memcache
+        from conference import ConferenceApi, MEMCACHE_SCHEDULE_KEY
+        memcache.delete_multi(sessions.keys(),
+                              key_prefix=MEMCACHE_SCHEDULE_KEY)
+        for wsck, sess_keys in sessions.items():
+            ConferenceApi._queueFeaturedSpeaker(wsck, sess_keys)
+
+    if notify:
+        tasks = [taskqueue.Task(
+            params={'email': e.key.parent().id(),
+                    'conferenceInfo': 'Imported conference: %s' % e.name},
+            url='/tasks/send_confirmation_email')
+            for e in entities if isinstance(e, Conference)]
+        # Queue.add takes at most 100 tasks per call
+        for i in range(0, len(tasks), 100):
+            taskqueue.Queue().add(tasks[i:i + 100])
+
+
+def importEntities(lines, batch_size=BATCH_SIZE, checkpoint=None,
+                   notify=False, inline=False):
+    """Load NDJSON lines, batch_size entities per put_multi.
+
+    Parents must come before children in the stream (exportEntities
+    writes Speakers, then Conferences, then Sessions). With a checkpoint
+    file lines already committed by a previous run are skipped; chunks
+    are keyed, so replaying one is harmless. With inline, featured
+    speakers are updated directly instead of through tasks and caches
+    are left alone (notify is not allowed). Returns the number of
+    entities written by this run.
+    """
+    if notify and inline:
+        raise ValueError('notify needs the task queue; not with inline')
+    import models  # registers the model classes
+
+    state = _readCheckpoint(checkpoint)
+    skip = state.get('line', 0)
+    line_no = 0
+    written = 0
+    chunk = []
+    for line in lines:
+        line_no += 1
+        if line_no <= skip or not line.strip():
+            continue
+        chunk.append(_fromJson(json.loads(line)))
+        if len(chunk) >= batch_size:
+            _importChunk(chunk, notify, inline)
+            written += len(chunk)
+            chunk = []
+            _writeCheckpoint(checkpoint, {'line': line_no})
+    if chunk:
+        _importChunk(chunk, notify, inline)
+        written += len(chunk)
+        _writeCheckpoint(checkpoint, {'line': line_no})
+    return written
+
+
+def _setupLocal(datastore_file):
+    """Point the API stubs at a local datastore file (e.g. the one the
+    dev_appserver uses) through the testbed."""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk and sdk not in sys.path:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.setup_env(app_id=os.environ.get('APPLICATION_ID', 'dev~conference'))
+    bed.activate()
+    bed.init_datastore_v3_stub(datastore_file=datastore_file,
+                               save_changes=True, use_sqlite=True)
+    bed.init_memcache_stub()
+    return bed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('mode', choices=('export', 'import'))
+    parser.add_argument('path', help='NDJSON file')
+    parser.add_argument('--datastore', required=True,
+                        help='local datastore file to read/write')
+    parser.add_argument('--kinds', default=','.join(KINDS))
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--checkpoint', help='resume/checkpoint file')
+    args = parser.parse_args()
+
+    bed = _setupLocal(args.datastore)
+    try:
+        if args.mode == 'export':
+            # append only when resuming; a fresh run starts the dump over
+            resuming = bool(_readCheckpoint(args.checkpoint))
+            with open(args.path, 'a' if resuming else 'w') as out:
+                count = exportEntities(out, args.kinds.split(','),
+                                       args.batch_size, args.checkpoint)
+        else:
+            with open(args.path) as lines:
+                count = importEntities(lines, args.batch_size,
+                                       args.checkpoint, inline=True)
+    finally:
+        bed.deactivate()
+    print '%sed %d entities' % (args.mode, count)
+
+
+if __name__ == '__main__':
+    main()
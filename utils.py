@@ -1,11 +1,23 @@
+import hashlib
 import json
 import os
 import time
 import uuid
 
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from models import Profile
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_ATTEMPTS = 3
+TOKENINFO_DEADLINE = 5
+MEMCACHE_USER_ID_KEY = "USER_ID_"
+USER_ID_TTL = 3600
+MEMCACHE_CONFERENCE_GENERATION_KEY = "CONFERENCE_GENERATION"
+
 def getTime(time):
     
     format = time.split(':')
@@ -13,6 +25,54 @@ def getTime(time):
     formated = int(format[0]) * 3600 + int(format[1]) * 60
     return formated
 
+def parseDate(value):
+    """Parse a 'YYYY-MM-DD' form string back to a date (None if unset)."""
+    if not value or value == 'None':
+        return None
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+def conferenceGeneration():
+    """Return the current generation of Conference query results.
+
+    A missing counter restarts from the clock in milliseconds, so
+    results cached under an evicted generation are never reused.
+    """
+    generation = memcache.get(MEMCACHE_CONFERENCE_GENERATION_KEY)
+    if generation is None:
+        memcache.add(MEMCACHE_CONFERENCE_GENERATION_KEY,
+                     int(time.time() * 1000))
+        generation = memcache.get(MEMCACHE_CONFERENCE_GENERATION_KEY)
+    return generation
+
+def bumpConferenceGeneration():
+    """Invalidate cached Conference query results; call after any
+    write that changes what a Conference query returns."""
+    memcache.incr(MEMCACHE_CONFERENCE_GENERATION_KEY,
+                  initial_value=int(time.time() * 1000))
+
+def scheduleOnceAsync(name_prefix, url, params=None, window=10):
+    """Start adding a push task named '<name_prefix>-<time bucket>', so
+    at most one is queued per window seconds; it runs after its bucket
+    closes and so sees everything done during it. Returns the RPC to
+    pass to waitScheduled."""
+    bucket = int(time.time() // window)
+    return taskqueue.Queue().add_async(
+        taskqueue.Task(name='%s-%d' % (name_prefix, bucket), url=url,
+                       params=params or {}, countdown=window))
+
+def waitScheduled(rpc):
+    """Wait for scheduleOnceAsync; a task already queued (or run) for
+    the bucket is not an error."""
+    try:
+        rpc.get_result()
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def scheduleOnce(name_prefix, url, params=None, window=10):
+    """scheduleOnceAsync, waited for."""
+    waitScheduled(scheduleOnceAsync(name_prefix, url, params, window))
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -21,25 +81,17 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        # tokeninfo answers are cached per token until the token expires
+        cache_key = MEMCACHE_USER_ID_KEY + hashlib.sha1(token).hexdigest()
+        user_id = memcache.get(cache_key)
+        if user_id is None:
+            info = _fetchTokenInfo(token)
+            user_id = info.get('user_id', '')
+            if user_id:
+                ttl = min(int(info.get('expires_in', USER_ID_TTL)),
+                          USER_ID_TTL)
+                memcache.set(cache_key, user_id, time=max(ttl, 1))
+        return user_id
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
@@ -50,3 +102,37 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+def _fetchTokenInfo(token):
+    """Return the tokeninfo dict for token, {} if it can't be verified.
+
+    When the token type isn't known both lookups are issued at once
+    rather than one after the other. Failed lookups (deadline, 5xx) are
+    retried at most TOKENINFO_ATTEMPTS times, straight away -- nothing
+    sleeps on the request thread.
+    """
+    if 'OAUTH_USER_ID' in os.environ:
+        pending = ['access_token']
+    else:
+        pending = ['id_token', 'access_token']
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        rpcs = []
+        for token_type in pending:
+            rpc = urlfetch.create_rpc(deadline=TOKENINFO_DEADLINE)
+            urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_type, token))
+            rpcs.append((token_type, rpc))
+        pending = []
+        for token_type, rpc in rpcs:
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                pending.append(token_type)
+                continue
+            if resp.status_code == 200:
+                return json.loads(resp.content)
+            # a 4xx means the token isn't of this type (or is invalid)
+            if resp.status_code >= 500:
+                pending.append(token_type)
+        if not pending:
+            break
+    return {}
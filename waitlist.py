@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""waitlist.py
+
+First come, first served waitlist for full Conferences. Registering for
+a conference with no free seat (or with people already waiting) adds a
+WaitlistEntry, a child of the user's Profile keyed by
+websafeConferenceKey, instead of failing, so clients stop retrying.
+When a seat is given back a /tasks/promote_waitlist task moves waiters
+onto registrations in the order they joined (ConferenceApi
+._promoteWaitlist). Positions come from a keys-only count and are
+memcached for POSITION_TTL seconds.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import WaitlistEntry
+from utils import scheduleOnce
+
+MEMCACHE_POSITION_KEY = "WAITLIST_POSITION_"
+POSITION_TTL = 30
+PROMOTE_DELAY = 2
+
+
+def entryKey(p_key, wsck):
+    return ndb.Key(WaitlistEntry, wsck, parent=p_key)
+
+
+def _positionKey(p_key, wsck):
+    return '%s%s:%s' % (MEMCACHE_POSITION_KEY, wsck, p_key.id())
+
+
+def hasWaiters(conf_key):
+    """Return True if anyone is waiting for a seat at the Conference."""
+    return WaitlistEntry.query(
+        WaitlistEntry.conference == conf_key).get(keys_only=True) is not None
+
+
+def waiters(conf_key, limit):
+    """Return the first limit WaitlistEntries of a Conference, oldest
+    first."""
+    return WaitlistEntry.query(
+        WaitlistEntry.conference == conf_key).order(
+            WaitlistEntry.queued, WaitlistEntry.key).fetch(limit)
+
+
+@ndb.transactional
+def join(p_key, wsck):
+    """Put the user at the back of the waitlist (no-op if already on
+    it); returns the WaitlistEntry."""
+    entry = entryKey(p_key, wsck).get()
+    if entry is None:
+        entry = WaitlistEntry(key=entryKey(p_key, wsck),
+                              conference=ndb.Key(urlsafe=wsck))
+        entry.put()
+    return entry
+
+
+@ndb.transactional
+def leave(p_key, wsck):
+    """Take the user off the waitlist; returns False if not on it."""
+    key = entryKey(p_key, wsck)
+    if key.get() is None:
+        return False
+    key.delete()
+    return True
+
+
+def position(p_key, wsck):
+    """Return the user's 1-based place in line, 0 if not waiting."""
+    memcache_key = _positionKey(p_key, wsck)
+    place = memcache.get(memcache_key)
+    if place is None:
+        entry = entryKey(p_key, wsck).get()
+        place = 0
+        if entry:
+            place = 1 + WaitlistEntry.query(
+                WaitlistEntry.conference == entry.conference,
+                WaitlistEntry.queued < entry.queued).count()
+        memcache.set(memcache_key, place, time=POSITION_TTL)
+    return place
+
+
+def forgetPosition(p_key, wsck):
+    memcache.delete(_positionKey(p_key, wsck))
+
+
+def schedulePromotion(wsck, transactional=False):
+    """Enqueue /tasks/promote_waitlist for a Conference; pass
+    transactional=True inside the transaction that frees the seat."""
+    taskqueue.add(params={'websafeConferenceKey': wsck},
+                  url='/tasks/promote_waitlist',
+                  transactional=transactional)
+
+
+def ensurePromotion(wsck):
+    """Enqueue at most one /tasks/promote_waitlist per Conference every
+    PROMOTE_DELAY seconds, for callers that find free seats while people
+    wait; the task runs after its time bucket closes."""
+    scheduleOnce('promote-%s' % wsck, '/tasks/promote_waitlist',
+                 {'websafeConferenceKey': wsck}, PROMOTE_DELAY)